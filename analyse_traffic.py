@@ -1,66 +1,294 @@
 #! /usr/bin/python3 -u
+'''
+Streaming analysis of Modbus RTU captures from https://github.com/sourceperl/modbus-serial-monitor.git
+eg
+    DATE=2022-05-17T19:42:03.197;ERR=NO;FRAME=02-04-00-00-00-12-70-34;SLAVE=2
 
+Captures are processed as a pipeline of generators over the lines so multi day files use constant memory.
+Each request is paired with its response by frame structure, then per request key the poll period and
+request to response latency percentiles, missing responses, CRC errors and the float register values
+are reported.
+
+    analyse_traffic.py SDM230RTUCapture.log other.log --start 2022-05-17T19:41:30 --end 2022-05-17T19:42:00
+
+Binary captures, see capture.py, are read through mmap and seek straight to the window. To convert
+    analyse_traffic.py SDM230RTUCapture.log --convert SDM230RTUCapture.cap
+'''
+
+import heapq
 import re
+import struct
+from argparse import ArgumentParser
 from datetime import datetime
-from statistics import mean, stdev
+from stats import Histogram
+from crc import computeCRC
+import capture
+
+
+CAPTURE_LINE = re.compile(r"DATE=(.*?);ERR=(.*?);FRAME=(.*?);")
 
-def decode_frame(frame):
-    unit = int(frame[0:2], 16)
-    function = int(frame[3:5], 16)
-    reg = int(frame[6:8], 16)*256 + int(frame[9:11], 16) 
-    count = int(frame[12:14], 16)*256 + int(frame[15:17], 16)
+
+def crcValid(frame) -> bool:
+    return len(frame) > 2 and computeCRC(frame, 0, len(frame)-2) == (frame[-2] << 8) | frame[-1]
+
+
+def decode_frame(frame) -> dict:
+    '''
+    Decode a request frame, as bytes.
+    '''
+    unit, function, reg, count = struct.unpack_from('>BBHH', frame, 0)
     return {
         'unit': unit,
         'function': function,
         'reg': reg,
-        'regHex': f'{frame[6:8]}{frame[9:11]}',
+        'regHex': f'{reg:04x}',
         'count': count
     }
 
 
+# --------------------------------------------------------------------------- #
+# Pipeline stages
+# --------------------------------------------------------------------------- #
+
+def readLines(files: list):
+    for fileName in files:
+        with open(fileName) as f:
+            for line in f:
+                yield line
+
+
+def parseCaptures(lines):
+    '''
+    Yields (timestamp, frame bytes, captureError) for each capture line, other lines are skipped.
+    '''
+    for line in lines:
+        if line.startswith('DATE='):
+            match = CAPTURE_LINE.match(line)
+            if match != None:
+                try:
+                    frame = bytes.fromhex(match.group(3).replace('-', ''))
+                except ValueError:
+                    continue
+                yield datetime.fromisoformat(match.group(1)).timestamp(), frame, match.group(2) != 'NO'
+
+
+def window(captures, start: float = None, end: float = None):
+    for capture in captures:
+        if start != None and capture[0] < start:
+            continue
+        if end != None and capture[0] >= end:
+            continue
+        yield capture
+
+
+REQUEST = 'request'
+RESPONSE = 'response'
+EXCEPTION = 'exception'
+MISSING = 'missing'
+CRC_ERROR = 'crcerror'
+UNKNOWN = 'unknown'
+
+
+def pairFrames(captures):
+    '''
+    Classify frames by structure and pair responses with the request before them.
+    A request is 8 bytes with a valid CRC. A response has the unit and function of the pending request
+    and a byte count of twice its register count, an exception has the function with the top bit set.
+    Yields (kind, timestamp, request, frame)
+    '''
+    pending = None
+    pendingTime = None
+    for timestamp, frame, captureError in captures:
+        valid = not captureError and crcValid(frame)
+        if pending != None and len(frame) >= 3 and frame[0] == pending[0]:
+            if frame[1] == pending[1] and len(frame) == 5 + frame[2] and frame[2] == 2*((pending[4] << 8) | pending[5]):
+                yield (RESPONSE if valid else CRC_ERROR), timestamp, pending, frame
+                if valid:
+                    pending = None
+                continue
+            if frame[1] == pending[1] | 0x80 and len(frame) == 5:
+                yield (EXCEPTION if valid else CRC_ERROR), timestamp, pending, frame
+                if valid:
+                    pending = None
+                continue
+        if len(frame) == 8:
+            if not valid:
+                yield CRC_ERROR, timestamp, None, frame
+                continue
+            if pending != None:
+                yield MISSING, pendingTime, pending, None
+            pending = frame
+            pendingTime = timestamp
+            yield REQUEST, timestamp, frame, None
+        else:
+            yield (UNKNOWN if valid else CRC_ERROR), timestamp, pending, frame
+    if pending != None:
+        yield MISSING, pendingTime, pending, None
+
+
+# --------------------------------------------------------------------------- #
+# Aggregation
+# --------------------------------------------------------------------------- #
+
+class RegisterValues(object):
+    def __init__(self) -> None:
+        self.count = 0
+        self.last = None
+        self.min = None
+        self.max = None
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.last = value
+        if self.min == None or value < self.min:
+            self.min = value
+        if self.max == None or value > self.max:
+            self.max = value
+
+
+class KeyStats(object):
+    '''
+    Everything known about one request key, unit, function, address and count.
+    '''
+    def __init__(self, request: bytes) -> None:
+        self.request = decode_frame(request)
+        self.requests = 0
+        self.responses = 0
+        self.exceptions = 0
+        self.missing = 0
+        self.crcErrors = 0
+        self.lastRequest = None
+        self.period = Histogram()
+        self.latency = Histogram()
+        self.registers = {}
+
+    def decodeFloats(self, frame: bytes) -> None:
+        data = frame[3:-2]
+        for offset in range(0, len(data) - 3, 4):
+            register = self.request['reg'] + offset//2
+            values = self.registers.get(register)
+            if values == None:
+                values = RegisterValues()
+                self.registers[register] = values
+            values.add(struct.unpack_from('>f', data, offset)[0])
+
+
+class TrafficStats(object):
+    def __init__(self) -> None:
+        self.keys = {}
+        self.crcErrors = 0
+        self.unknown = 0
+        self.frames = 0
+        self.first = None
+        self.last = None
+
+    def keyStats(self, request: bytes) -> KeyStats:
+        key = request[0:6]
+        stats = self.keys.get(key)
+        if stats == None:
+            stats = KeyStats(request)
+            self.keys[key] = stats
+        return stats
+
+    def add(self, event) -> None:
+        kind, timestamp, request, frame = event
+        if kind != MISSING:
+            self.frames += 1
+            if self.first == None:
+                self.first = timestamp
+            self.last = timestamp
+        if kind == REQUEST:
+            stats = self.keyStats(request)
+            stats.requests += 1
+            if stats.lastRequest != None:
+                stats.period.record(timestamp - stats.lastRequest)
+            stats.lastRequest = timestamp
+        elif kind == RESPONSE or kind == EXCEPTION:
+            stats = self.keyStats(request)
+            stats.latency.record(timestamp - stats.lastRequest)
+            if kind == RESPONSE:
+                stats.responses += 1
+                stats.decodeFloats(frame)
+            else:
+                stats.exceptions += 1
+        elif kind == MISSING:
+            self.keyStats(request).missing += 1
+        elif kind == CRC_ERROR:
+            self.crcErrors += 1
+            if request != None:
+                self.keyStats(request).crcErrors += 1
+        else:
+            self.unknown += 1
+
+    def report(self, floats: bool = True) -> None:
+        if self.first != None:
+            print(f'{datetime.fromtimestamp(self.first).isoformat()} to {datetime.fromtimestamp(self.last).isoformat()} '
+                  f'frames:{self.frames} crcErrors:{self.crcErrors} unknown:{self.unknown}')
+        print('unit fn  reg count  reqs  resp  miss   crc   exc  period p50/p90/p99 s         latency p50/p90/p99 ms')
+        for key, stats in sorted(self.keys.items()):
+            r = stats.request
+            print(f"{r['unit']:4d} {r['function']:2d} {r['regHex']} {r['count']:5d} {stats.requests:5d} {stats.responses:5d} "
+                  f"{stats.missing:5d} {stats.crcErrors:5d} {stats.exceptions:5d}  "
+                  f"{stats.period.percentile(50):6.3f} {stats.period.percentile(90):6.3f} {stats.period.percentile(99):6.3f}  "
+                  f"{stats.latency.percentile(50)*1000:9.1f} {stats.latency.percentile(90)*1000:6.1f} {stats.latency.percentile(99)*1000:6.1f}")
+            if floats:
+                for register, values in sorted(stats.registers.items()):
+                    if values.min != 0.0 or values.max != 0.0:
+                        print(f'        {register:04x} last:{values.last:.4f} min:{values.min:.4f} max:{values.max:.4f}')
+
+
+def parseTime(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+
+def readCaptures(files: list, start: float = None, end: float = None):
+    '''
+    Yields (timestamp, frame bytes, captureError) in the window from text or binary captures.
+    '''
+    for fileName in files:
+        if capture.isCapture(fileName):
+            reader = capture.CaptureReader(fileName)
+            try:
+                yield from reader.frames(start, end)
+            finally:
+                reader.close()
+        else:
+            yield from window(parseCaptures(readLines([fileName])), start, end)
+
+
+def convert(files: list, output: str, start: float = None, end: float = None) -> int:
+    '''
+    Write the captures to one binary capture, returns the number of frames. Files are merged
+    by timestamp, each must be in time order itself, as the capture index needs ordered frames.
+    '''
+    captures = heapq.merge(*[readCaptures([fileName], start, end) for fileName in files], key=lambda capture: capture[0])
+    with capture.CaptureWriter(output) as writer:
+        for timestamp, frame, captureError in captures:
+            request = len(frame) == 8 and not captureError and crcValid(frame)
+            writer.add(timestamp, frame, capture.DIRECTION_REQUEST if request else capture.DIRECTION_RESPONSE, captureError)
+        return writer.count
+
+
+def analyse(files: list, start: float = None, end: float = None) -> TrafficStats:
+    stats = TrafficStats()
+    for event in pairFrames(readCaptures(files, start, end)):
+        stats.add(event)
+    return stats
+
 
 def main():
-    requests = {}
-    with open("SDM230RTUCapture.log") as file:
-        isLeader = True
-        lastRequest = None
-        for item in file:
-            if item.startswith('DATE='):
-                #  DATE=2022-05-17T19:42:03.197;ERR=NO;FRAME=02-04-00-00-00-12-70-34;SLAVE=2
-
-                match = re.match(r"DATE=(.*?);ERR=NO;FRAME=(.*?);SLAVE", item)
-                if match != None:
-                    date = datetime.fromisoformat(match.group(1))
-                    frame = match.group(2)
-                    if isLeader:
-                        if not frame in requests:
-                            requests[frame] = {
-                                'req': [],
-                                'res': []
-                            }
-                        requests[frame]['req'].append({
-                                'date': date,
-                                'frame': frame,
-                        })
-                        lastRequest = requests[frame];
-                    else:
-                        if lastRequest != None:
-                            lastRequest['res'].append({
-                                'date': date,
-                                'frame': frame,
-                            })
-                    isLeader = not isLeader
-    for k in requests:
-        d1 = None
-        period = []
-        req = requests[k]['req']
-        for i in range(len(req)):
-            d2 = req[i]['date']
-            if d1 != None:
-                period.append((d2-d1).total_seconds())
-            d1 = d2
-
-        print(f'{decode_frame(k)} {mean(period)} {stdev(period)}')
+    parser = ArgumentParser(add_help=True, description='Analyse Modbus RTU captures')
+    parser.add_argument('files', nargs='*', default=['SDM230RTUCapture.log'])
+    parser.add_argument('--start', type=parseTime, help='ignore frames before this ISO time')
+    parser.add_argument('--end', type=parseTime, help='ignore frames from this ISO time')
+    parser.add_argument('--no-floats', help='dont decode the response registers as floats',
+                        action='store_true')
+    parser.add_argument('--convert', metavar='OUTPUT', help='write the frames to a binary capture rather than analyse them')
+    args = parser.parse_args()
+    if args.convert:
+        print(f'{convert(args.files, args.convert, args.start, args.end)} frames written to {args.convert}')
+        return
+    analyse(args.files, args.start, args.end).report(not args.no_floats)
 
 
 if __name__ == "__main__":
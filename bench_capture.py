@@ -0,0 +1,72 @@
+#! /usr/bin/python3 -u
+'''
+Conversion and scan throughput of the binary capture format against the text capture.
+The sample capture is repeated with shifted timestamps to make a larger file.
+
+    python bench_capture.py --repeat 200
+'''
+
+import os
+import time
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import analyse_traffic
+import capture
+
+
+def makeText(source: str, output: str, repeat: int) -> None:
+    with open(source) as f:
+        lines = [line for line in f if line.startswith('DATE=')]
+    first = datetime.fromisoformat(lines[0][5:28])
+    last = datetime.fromisoformat(lines[-1][5:28])
+    span = last - first + timedelta(seconds=1)
+    with open(output, 'w') as f:
+        for n in range(repeat):
+            for line in lines:
+                t = datetime.fromisoformat(line[5:28]) + n*span
+                f.write(f"DATE={t.isoformat(timespec='milliseconds')}{line[28:]}")
+
+
+def timed(label: str, frames: int, size: int, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f'{label:28s} {elapsed:7.3f}s {frames/elapsed:10.0f} frames/s {size/elapsed/1e6:7.1f} MB/s')
+    return result
+
+
+def main():
+    parser = ArgumentParser(add_help=True, description='Binary capture throughput')
+    parser.add_argument('--source', default='SDM230RTUCapture.log')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        text = os.path.join(tmp, 'capture.log')
+        binary = os.path.join(tmp, 'capture.cap')
+        makeText(args.source, text, args.repeat)
+        textSize = os.path.getsize(text)
+        frames = sum(1 for _ in analyse_traffic.parseCaptures(analyse_traffic.readLines([text])))
+        timed('convert', frames, textSize, lambda: analyse_traffic.convert([text], binary))
+        binarySize = os.path.getsize(binary)
+        print(f'text {textSize} bytes, binary {binarySize} bytes, {textSize/binarySize:.1f}x smaller, {frames} frames')
+
+        timed('scan text', frames, textSize,
+            lambda: sum(1 for _ in analyse_traffic.parseCaptures(analyse_traffic.readLines([text]))))
+        reader = capture.CaptureReader(binary)
+        timed('scan binary', frames, binarySize, lambda: sum(1 for _ in reader.frames()))
+        timed('analyse text', frames, textSize, lambda: analyse_traffic.analyse([text]))
+        timed('analyse binary', frames, binarySize, lambda: analyse_traffic.analyse([binary]))
+
+        # the last 1% of the capture, the text has to be read up to it, the binary seeks
+        start = reader.indexTimes[-1]/1e6 - (reader.indexTimes[-1] - reader.indexTimes[0])/1e8
+        window = sum(1 for _ in reader.frames(start))
+        timed('window text', window, textSize,
+            lambda: sum(1 for _ in analyse_traffic.window(analyse_traffic.parseCaptures(analyse_traffic.readLines([text])), start)))
+        timed('window binary', window, binarySize, lambda: sum(1 for _ in reader.frames(start)))
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#! /usr/bin/python3 -u
+'''
+Compare serving N ports from one process against N processes with one port each.
+Each port is a CannedSerial, which polls at the inverters 5Hz rate, served with the mock DBus.
+Reports total RSS and CPU time across the processes.
+
+    python bench_ports.py --duration 10 --ports 1 2 4 8
+'''
+
+import sys
+import os
+import time
+import threading
+import subprocess
+from argparse import ArgumentParser
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'mocks'))
+from datastore import SD230DataStore
+from modbus import ModbusRTUSerialServer, CannedSerial
+
+import logging
+
+
+def rssKb() -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def child(ports: int, duration: float) -> None:
+    '''
+    Serve ports CannedSerial ports from this process sharing one datastore, then
+    print rss_kb cpu_s frames.
+    '''
+    logging.basicConfig(level=logging.WARNING)
+    datastore = SD230DataStore()
+    datastore.gridTracker = False
+    datastore.useServiceTracker = True
+    for path in datastore.paths:
+        datastore.setValue(path, 230.0)
+    servers = [ModbusRTUSerialServer(datastore, CannedSerial(), unit=0x02) for n in range(ports)]
+    end = time.time() + duration
+    def run(server):
+        while time.time() < end:
+            server.handle(threaded=True)
+    threads = [threading.Thread(target=run, args=(server,)) for server in servers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cpu = os.times()
+    frames = sum(server.totalPacketCount for server in servers)
+    print(f'{rssKb()} {cpu.user + cpu.system} {frames}')
+
+
+def measure(processes: int, portsPerProcess: int, duration: float) -> tuple:
+    children = [subprocess.Popen([sys.executable, __file__, '--child', str(portsPerProcess), '--duration', str(duration)],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True) for n in range(processes)]
+    rss = 0
+    cpu = 0.0
+    frames = 0
+    for p in children:
+        out = p.communicate()[0].split('\n')[-2].split()
+        rss += int(out[0])
+        cpu += float(out[1])
+        frames += int(out[2])
+    return rss, cpu, frames
+
+
+def main():
+    parser = ArgumentParser(add_help=True)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--ports', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--child', type=int)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.duration)
+        return
+    print('ports processes  rss_kb  cpu_s  frames')
+    for ports in args.ports:
+        for processes in sorted(set([1, ports])):
+            rss, cpu, frames = measure(processes, ports//processes, args.duration)
+            print(f'{ports:5d} {processes:9d} {rss:7d} {cpu:6.2f} {frames:7d}')
+
+
+if __name__ == "__main__":
+    main()
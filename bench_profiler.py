@@ -0,0 +1,75 @@
+#! /usr/bin/python3 -u
+'''
+Cost of the sampling profiler. A port thread answers requests as fast as it can with the mock DBus
+while the profiler samples it, the reply time percentiles are compared with profiling off.
+
+    python bench_profiler.py --duration 5
+'''
+
+import sys
+import os
+import time
+import tempfile
+import threading
+from argparse import ArgumentParser
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'mocks'))
+from datastore import SD230DataStore
+from modbus import ModbusRTUSerialServer, CannedSerial
+from profiler import SamplingProfiler
+from stats import Histogram
+
+
+class NullSerial(object):
+    name = 'null'
+    def write(self, data) -> None:
+        pass
+    def flush(self) -> None:
+        pass
+    def close(self) -> None:
+        pass
+
+
+def serve(server: ModbusRTUSerialServer, duration: float) -> None:
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        for frame in CannedSerial.testpattern:
+            server.processIncomingPacket(frame)
+
+
+def run(datastore: SD230DataStore, duration: float, interval: float = None) -> None:
+    server = ModbusRTUSerialServer(datastore, NullSerial())
+    thread = threading.Thread(target=serve, args=(server, duration), name='serial')
+    with tempfile.TemporaryDirectory() as tmp:
+        profiler = SamplingProfiler(tmp, interval or 0.01)
+        thread.start()
+        profiler.watch('serial', thread.ident)
+        profiler.watch('glib', threading.main_thread().ident)
+        if interval:
+            profiler.start()
+        thread.join()
+        profiler.stop()
+    label = f'sampling every {interval*1000:.0f}ms' if interval else 'off'
+    r = server.responseTime
+    print(f'{label:22s} replies:{r.count:7d} p50:{r.percentile(50)*1e6:6.0f}us p99:{r.percentile(99)*1e6:6.0f}us '
+          f'max:{r.max*1e6:6.0f}us', end='')
+    if interval:
+        s = profiler.sampleTime
+        print(f'  samples:{s.count} cost p50:{s.percentile(50)*1e6:.0f}us p99:{s.percentile(99)*1e6:.0f}us stacks:{len(profiler.stacks)}')
+    else:
+        print()
+
+
+def main():
+    parser = ArgumentParser(add_help=True, description='Sampling profiler overhead')
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    datastore = SD230DataStore()
+    for interval in (None, 0.01, 0.001):
+        run(datastore, args.duration, interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#! /usr/bin/python3 -u
+'''
+Loopback load test for the Modbus TCP server.
+Runs the server with the mock DBus in this process and the clients in a child process,
+each client keeps one request in flight and records the round trip time.
+
+    python bench_tcp.py --duration 5 --clients 1 10 50
+'''
+
+import sys
+import os
+import time
+import socket
+import selectors
+import struct
+import threading
+import multiprocessing
+from argparse import ArgumentParser
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'mocks'))
+from datastore import SD230DataStore
+from modbustcp import ModbusTCPServer
+from stats import Histogram
+
+
+def runClients(port: int, clients: int, duration: float, results) -> None:
+    '''
+    Drive all clients from one selector loop so the client side is cheap.
+    '''
+    selector = selectors.DefaultSelector()
+    latency = Histogram()
+    requests = 0
+    for n in range(clients):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        state = {'tid': 0, 'sent': 0.0, 'rx': bytearray()}
+        selector.register(sock, selectors.EVENT_READ, state)
+    def send(sock, state):
+        state['tid'] = (state['tid'] + 1) & 0xffff
+        state['sent'] = time.perf_counter()
+        sock.send(struct.pack('>HHHBBHH', state['tid'], 0, 6, 2, 4, 0, 18))
+    for key in selector.get_map().values():
+        send(key.fileobj, key.data)
+    end = time.time() + duration
+    while time.time() < end:
+        for key, events in selector.select(0.5):
+            state = key.data
+            state['rx'] += key.fileobj.recv(4096)
+            # 9 byte header + 36 bytes of registers
+            while len(state['rx']) >= 45:
+                del state['rx'][:45]
+                latency.record(time.perf_counter() - state['sent'])
+                requests += 1
+                send(key.fileobj, state)
+    results.put((requests, latency.summary()))
+
+
+def main():
+    parser = ArgumentParser(add_help=True)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50])
+    args = parser.parse_args()
+
+    datastore = SD230DataStore()
+    datastore.gridTracker = False
+    datastore.useServiceTracker = True
+    for path in datastore.paths:
+        datastore.setValue(path, 230.0)
+    server = ModbusTCPServer(datastore, port=0, host='127.0.0.1')
+    running = True
+    def serve():
+        while running:
+            server.handle(0.1)
+    thread = threading.Thread(target=serve)
+    thread.start()
+    try:
+        print('clients req/s     p50_ms  p90_ms  p99_ms  max_ms')
+        for clients in args.clients:
+            results = multiprocessing.Queue()
+            p = multiprocessing.Process(target=runClients, args=(server.port, clients, args.duration, results))
+            p.start()
+            requests, latency = results.get()
+            p.join()
+            print(f"{clients:7d} {requests/args.duration:9.0f} {latency['p50']*1000:7.3f} {latency['p90']*1000:7.3f} {latency['p99']*1000:7.3f} {latency['max']*1000:7.3f}")
+    finally:
+        running = False
+        thread.join()
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import json
+import time
+from stats import Histogram
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class UnitStats(object):
+    '''
+    Traffic seen for one unit on the bus.
+    '''
+    def __init__(self, unit: int) -> None:
+        self.unit = unit
+        self.requests = {}
+        self.responses = 0
+        self.exceptions = 0
+        self.missing = 0
+        self.lastRequest = {}
+        self.pollPeriod = Histogram()
+        self.turnaround = Histogram()
+
+    def summary(self, elapsed: float) -> dict:
+        total = sum(self.requests.values())
+        return {
+            'unit': self.unit,
+            'requests': {f'{k >> 32}:{(k >> 16) & 0xffff}:{k & 0xffff}': n for k, n in self.requests.items()},
+            'pollRate': total/elapsed if elapsed > 0 else 0.0,
+            'responses': self.responses,
+            'exceptions': self.exceptions,
+            'missing': self.missing,
+            'pollPeriod': self.pollPeriod.summary(),
+            'turnaround': self.turnaround.summary(),
+        }
+
+
+class BusAnalyser(object):
+    '''
+    Passive analysis of everything on the shared RS485 line, fed by the RTU server scanner.
+    Requests and the responses that follow them are classified per unit, giving poll rates and
+    turnaround times. Bus utilisation and the idle windows between bursts of bytes are estimated
+    from the character time at the configured baud rate, the idle windows are what our replies
+    have to fit into.
+    '''
+
+    def __init__(self, baudrate: int = 9600, reportPeriod: float = 60, dumpFile: str = None,
+            responseTimeout: float = 0.5) -> None:
+        """
+        :param baudrate: The bus baud rate, 8N1 is assumed
+        :param reportPeriod: seconds between summaries in the log
+        :param dumpFile: if set the full summary is written here as json each period
+        :param responseTimeout: seconds after which an unanswered request is counted as missing
+        """
+        self.charTime = 10.0/baudrate
+        self.reportPeriod = reportPeriod
+        self.responseTimeout = responseTimeout
+        self.dumpFile = dumpFile
+        self.units = {}
+        self.idle = Histogram()
+        self.pending = None
+        self.reset(time.perf_counter())
+
+    def reset(self, now: float) -> None:
+        self.started = now
+        self.lastReport = now
+        self.lastByte = None
+        self.rxBytes = 0
+        self.txBytes = 0
+
+    def unitStats(self, unit: int) -> UnitStats:
+        stats = self.units.get(unit)
+        if stats == None:
+            stats = UnitStats(unit)
+            self.units[unit] = stats
+        return stats
+
+    def onReceive(self, size: int, now: float) -> None:
+        '''
+        A chunk of size bytes finished arriving at now, so started size character times earlier.
+        '''
+        start = now - size*self.charTime
+        if self.lastByte != None and start > self.lastByte:
+            self.idle.record(start - self.lastByte)
+        self.lastByte = now
+        self.rxBytes += size
+
+    def onTransmit(self, size: int, now: float) -> None:
+        self.lastByte = now + size*self.charTime
+        self.txBytes += size
+
+    def onRequest(self, request, now: float, ours: bool = False) -> None:
+        '''
+        A valid request was decoded, if it is ours no response will be seen on the receive side.
+        '''
+        stats = self.unitStats(request.unit_id)
+        key = (request.function << 32) | (request.address << 16) | request.count
+        stats.requests[key] = stats.requests.get(key, 0) + 1
+        last = stats.lastRequest.get(key)
+        if last != None:
+            stats.pollPeriod.record(now - last)
+        stats.lastRequest[key] = now
+        if self.pending != None:
+            # the previous request was never answered
+            self.unitStats(self.pending[0].unit_id).missing += 1
+        # the server reuses its request object for the next frame
+        self.pending = None if ours else (request.copy(), now)
+
+    def matchResponse(self, buffer, start: int, crcCheck) -> int:
+        '''
+        If buffer at start holds the response to the pending request, classify it and
+        return its length so the scanner can skip it, otherwise 0.
+        Returns -1 if the response may be there but is not complete yet, a header that is
+        followed by a whole request frame is not waited for.
+        '''
+        if self.pending == None:
+            return 0
+        request, requestTime = self.pending
+        now = time.perf_counter()
+        if now - requestTime > self.responseTimeout:
+            self.unitStats(request.unit_id).missing += 1
+            self.pending = None
+            return 0
+        available = len(buffer) - start
+        if available < 5 or buffer[start] != request.unit_id:
+            return -1 if available < 5 and (available == 0 or buffer[start] == request.unit_id) else 0
+        function = buffer[start+1]
+        if function == request.function | 0x80:
+            length = 5
+        elif function == request.function and buffer[start+2] == request.count*2:
+            length = 5 + request.count*2
+        else:
+            return 0
+        if available < length:
+            if available >= 8 and crcCheck(buffer[start:start+6], (buffer[start+6] << 8) | buffer[start+7]):
+                # a valid request frame, eg the master polling an absent unit again, rather than
+                # the start of a response, scan it instead of waiting out the response timeout
+                return 0
+            return -1
+        frame = buffer[start:start+length]
+        if not crcCheck(frame[:-2], (frame[-2] << 8) | frame[-1]):
+            return 0
+        stats = self.unitStats(request.unit_id)
+        if length == 5:
+            stats.exceptions += 1
+        else:
+            stats.responses += 1
+        stats.turnaround.record(max(0.0, now - requestTime - length*self.charTime))
+        self.pending = None
+        return length
+
+    def summary(self) -> dict:
+        now = time.perf_counter()
+        elapsed = now - self.started
+        busy = (self.rxBytes + self.txBytes)*self.charTime
+        return {
+            'elapsed': elapsed,
+            'rxBytes': self.rxBytes,
+            'txBytes': self.txBytes,
+            'utilisation': busy/elapsed if elapsed > 0 else 0.0,
+            'idle': self.idle.summary(),
+            'idleP10': self.idle.percentile(10),
+            'units': [stats.summary(elapsed) for unit, stats in sorted(self.units.items())],
+        }
+
+    def compactSummary(self, summary: dict) -> str:
+        line = f"bus {summary['utilisation']*100:.1f}% idle p10:{summary['idleP10']*1000:.1f}ms p50:{summary['idle']['p50']*1000:.1f}ms"
+        for unit in summary['units']:
+            line += f" | u{unit['unit']} {unit['pollRate']:.1f}/s ta p90:{unit['turnaround']['p90']*1000:.1f}ms miss:{unit['missing']} ex:{unit['exceptions']}"
+        return line
+
+    def dump(self, summary: dict) -> None:
+        with open(self.dumpFile, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    def checkReport(self, now: float) -> None:
+        if now - self.lastReport > self.reportPeriod:
+            self.lastReport = now
+            summary = self.summary()
+            log.info(self.compactSummary(summary))
+            if self.dumpFile:
+                try:
+                    self.dump(summary)
+                except OSError as e:
+                    log.error(f'Cant write {self.dumpFile} {e}')
@@ -0,0 +1,124 @@
+'''
+Compact binary capture of RTU frames.
+
+    header  magic, version, index interval, index offset, frame count
+    frames  timestamp us (int64), direction, flags, length (uint16), raw frame bytes
+    index   (timestamp us, file offset) of every indexEvery'th frame
+
+Frames are written in time order so a reader can bisect the sparse index and seek
+straight to a time range, then walk fixed width record headers without any parsing.
+The writer rejects a frame older than the one before it, merge several sources by time first.
+'''
+
+import mmap
+import struct
+from bisect import bisect_right
+
+MAGIC = b'SDMCAP\x00\x01'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQ')
+RECORD = struct.Struct('<qBBH')
+INDEX_ENTRY = struct.Struct('<qQ')
+
+DIRECTION_REQUEST = 0
+DIRECTION_RESPONSE = 1
+FLAG_CAPTURE_ERROR = 0x01
+
+
+def isCapture(fileName: str) -> bool:
+    with open(fileName, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class CaptureWriter(object):
+    def __init__(self, fileName: str, indexEvery: int = 64) -> None:
+        self.f = open(fileName, 'wb')
+        self.indexEvery = indexEvery
+        self.index = []
+        self.count = 0
+        self.last = None
+        self.offset = HEADER.size
+        self.f.write(HEADER.pack(MAGIC, VERSION, indexEvery, 0, 0))
+
+    def add(self, timestamp: float, frame: bytes, direction: int, captureError: bool = False) -> None:
+        us = int(round(timestamp*1e6))
+        if self.last != None and us < self.last:
+            raise ValueError(f'frame at {us}us is before the previous one at {self.last}us, the index needs time order')
+        self.last = us
+        if self.count % self.indexEvery == 0:
+            self.index.append((us, self.offset))
+        self.f.write(RECORD.pack(us, direction, FLAG_CAPTURE_ERROR if captureError else 0, len(frame)))
+        self.f.write(frame)
+        self.offset += RECORD.size + len(frame)
+        self.count += 1
+
+    def close(self) -> None:
+        for entry in self.index:
+            self.f.write(INDEX_ENTRY.pack(*entry))
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, self.indexEvery, self.offset, self.count))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class CaptureReader(object):
+    '''
+    Read only view of a binary capture through mmap.
+    '''
+    def __init__(self, fileName: str) -> None:
+        self.f = open(fileName, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.indexEvery, self.indexOffset, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{fileName} is not a version {VERSION} capture')
+        entries = (len(self.mm) - self.indexOffset)//INDEX_ENTRY.size
+        self.indexTimes = []
+        self.indexOffsets = []
+        for n in range(entries):
+            us, offset = INDEX_ENTRY.unpack_from(self.mm, self.indexOffset + n*INDEX_ENTRY.size)
+            self.indexTimes.append(us)
+            self.indexOffsets.append(offset)
+
+    def seek(self, start: float = None) -> int:
+        '''
+        Offset of the indexed frame at or before start.
+        '''
+        if start == None or not self.indexTimes:
+            return HEADER.size
+        n = bisect_right(self.indexTimes, int(start*1e6)) - 1
+        return self.indexOffsets[max(n, 0)]
+
+    def records(self, start: float = None, end: float = None):
+        '''
+        Yields (timestamp us, direction, flags, frame) for frames in [start, end)
+        '''
+        mm = self.mm
+        unpack = RECORD.unpack_from
+        offset = self.seek(start)
+        startUs = None if start == None else int(start*1e6)
+        endUs = None if end == None else int(end*1e6)
+        while offset < self.indexOffset:
+            us, direction, flags, length = unpack(mm, offset)
+            offset += RECORD.size
+            if endUs != None and us >= endUs:
+                return
+            if startUs == None or us >= startUs:
+                yield us, direction, flags, mm[offset:offset+length]
+            offset += length
+
+    def frames(self, start: float = None, end: float = None):
+        '''
+        Yields (timestamp, frame bytes, captureError) as analyse_traffic.parseCaptures does.
+        '''
+        for us, direction, flags, frame in self.records(start, end):
+            yield us/1e6, frame, flags & FLAG_CAPTURE_ERROR != 0
+
+    def close(self) -> None:
+        self.mm.close()
+        self.f.close()
@@ -0,0 +1,162 @@
+import json
+import time
+from meterprofiles import loadProfiles
+from dataage import DataAgeTracer
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# keys of the config file and the types they take, ints are accepted for floats
+SETTINGS = {
+    'bind': list,
+    'profileDir': str,
+    'valueTTL': float,
+    'missingRetry': float,
+    'echo': bool,
+    'lowLatency': bool,
+    'traceAge': bool,
+    'logLevels': dict,
+}
+
+
+class Binding:
+    '''
+    One serial port served by the process, DEVICE[:UNIT[:PROFILE[:RATE]]]
+    eg /dev/ttyUSB0:2:sdm230:9600, unit is decimal or 0x hex.
+    '''
+    def __init__(self, tty: str, unit: int = 0x02, profile: str = 'sdm230', rate: int = 9600) -> None:
+        self.tty = tty
+        self.unit = unit
+        self.profile = profile
+        self.rate = rate
+
+    @classmethod
+    def parse(cls, text: str, rate: int) -> 'Binding':
+        parts = text.split(':')
+        binding = cls(parts[0], rate=rate)
+        if len(parts) > 1 and parts[1]:
+            binding.unit = int(parts[1], 0)
+        if len(parts) > 2 and parts[2]:
+            binding.profile = parts[2]
+        if len(parts) > 3 and parts[3]:
+            binding.rate = int(parts[3])
+        return binding
+
+    def __str__(self) -> str:
+        return f'{self.tty}:{self.unit}:{self.profile}:{self.rate}'
+
+
+def loadConfig(fileName: str) -> dict:
+    '''
+    Read and check the json config file, raises ValueError if anything in it is wrong
+    so a bad edit never gets half applied.
+
+        {
+            "bind": ["/dev/ttyUSB0:2:sdm230:9600"],
+            "profileDir": "/data/sdm230device/profiles",
+            "valueTTL": 0.1,
+            "missingRetry": 60,
+            "echo": false,
+            "lowLatency": true,
+            "traceAge": false,
+            "logLevels": {"": "INFO", "modbus": "DEBUG"}
+        }
+
+    Every key is optional, a key left out keeps its current value.
+    '''
+    with open(fileName) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f'{fileName} is not a json object')
+    for key, value in config.items():
+        if key not in SETTINGS:
+            raise ValueError(f'{fileName} unknown setting {key}, available {sorted(SETTINGS)}')
+        expected = SETTINGS[key]
+        if expected == float and isinstance(value, int) and not isinstance(value, bool):
+            config[key] = float(value)
+        elif not isinstance(value, expected):
+            raise ValueError(f'{fileName} {key} should be a {expected.__name__}')
+    for name, level in config.get('logLevels', {}).items():
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f'{fileName} logger {name} unknown level {level}')
+    for text in config.get('bind', []):
+        Binding.parse(text, 9600)
+    return config
+
+
+def applyLogLevels(levels: dict) -> None:
+    '''
+    Set logger levels by name, '' is the root logger.
+    '''
+    for name, level in levels.items():
+        logging.getLogger(name if name else None).setLevel(level)
+
+
+class ConfigReloader(object):
+    '''
+    Applies the config file again without a restart, on SIGHUP. The file and the profiles it
+    names are loaded and the register plans compiled here, on the main loop, and nothing is
+    changed if any of that fails. Each port is then handed its new settings and its own thread
+    swaps to them between frames, reopening the port only if the baud rate or low latency changed.
+    The value cache, the grid service connection and the status service are kept.
+    Ports are matched by device, adding or removing a port needs a restart.
+    '''
+
+    def __init__(self, fileName: str, servers: list, datastore, rate: int = 9600, collector=None) -> None:
+        self.fileName = fileName
+        self.servers = servers
+        self.datastore = datastore
+        self.rate = rate
+        self.collector = collector
+        self.reloads = 0
+
+    def reload(self) -> bool:
+        start = time.perf_counter()
+        try:
+            config = loadConfig(self.fileName)
+            profiles = loadProfiles(config.get('profileDir', self.datastore.profileDir))
+            if 'bind' in config:
+                bindings = [Binding.parse(text, self.rate) for text in config['bind']]
+            else:
+                # every port keeps its binding, only the profiles and switches change
+                bindings = [Binding(server.device, server.unit, server.profile.name, server.baudrate) for server in self.servers]
+            for binding in bindings:
+                if binding.profile not in profiles:
+                    raise ValueError(f'{binding} unknown profile, available {sorted(profiles)}')
+        except Exception as e:
+            # anything a bad file or profile raises, escaping would drop the GLib signal source
+            # and later reloads would silently stop working
+            log.error(f'Reload of {self.fileName} failed, running config kept, {type(e).__name__} {e}')
+            return True
+        loaded = time.perf_counter()
+
+        applyLogLevels(config.get('logLevels', {}))
+        datastore = self.datastore
+        datastore.setProfiles(profiles, config.get('profileDir', datastore.profileDir))
+        datastore.valueTTL = config.get('valueTTL', datastore.valueTTL)
+        datastore.missingRetry = config.get('missingRetry', datastore.missingRetry)
+        ageTracer = next((server.ageTracer for server in self.servers if server.ageTracer != None), None)
+        if config.get('traceAge', ageTracer != None):
+            if ageTracer == None:
+                ageTracer = DataAgeTracer(datastore)
+        else:
+            ageTracer = None
+        if self.collector != None:
+            self.collector.ageTracer = ageTracer
+
+        servers = {str(server.device): server for server in self.servers}
+        for binding in bindings:
+            server = servers.pop(str(binding.tty), None)
+            if server == None:
+                log.warning(f'{binding} is not served, adding a port needs a restart')
+                continue
+            server.reconfigure(profiles[binding.profile], binding.unit, binding.rate,
+                config.get('lowLatency', server.lowLatency), config.get('echo', server.expectEcho), ageTracer)
+        for device in servers:
+            log.warning(f'{device} is no longer configured, still served until a restart')
+        self.reloads += 1
+        log.info(f'Reloaded {self.fileName}, load and compile {(loaded-start)*1000:.1f}ms, '
+            f'applied {(time.perf_counter()-loaded)*1000:.1f}ms, ports swap between frames')
+        # keep the GLib signal source
+        return True
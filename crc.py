@@ -0,0 +1,46 @@
+'''
+Modbus RTU CRC, standard library only so the offline capture tools can use it without
+pyserial or dbus.
+'''
+
+
+def generateCRC16Table() -> list:
+    """ Generates a crc16 lookup table
+
+    .. note:: This will only be generated once
+    """
+    result = []
+    for byte in range(256):
+        crc = 0x0000
+        for _ in range(8):
+            if (byte ^ crc) & 0x0001:
+                crc = (crc >> 1) ^ 0xa001
+            else: crc >>= 1
+            byte >>= 1
+        result.append(crc)
+    return result
+
+CRC16_TABLE = generateCRC16Table()
+
+
+def computeCRC(data, start: int = 0, end: int = None) -> int:
+    """ Computes a crc16 on the passed in string. For modbus,
+    this is only used on the binary serial protocols (in this
+    case RTU).
+
+    The difference between modbus's crc16 and a normal crc16
+    is that modbus starts the crc value out at 0xffff.
+
+    :param data: The data to create a crc16 of
+    :param start: The first byte of data to include, so frames can be checked in place
+    :param end: One past the last byte to include, default the end of data
+    :returns: The calculated CRC, high byte first as transmitted
+    """
+    if end == None:
+        end = len(data)
+    table = CRC16_TABLE
+    crc = 0xffff
+    for i in range(start, end):
+        crc = ((crc >> 8) & 0xff) ^ table[(crc ^ data[i]) & 0xff]
+    swapped = ((crc << 8) & 0xff00) | ((crc >> 8) & 0x00ff)
+    return swapped
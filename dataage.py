@@ -0,0 +1,66 @@
+import time
+from stats import Histogram
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class PathAge(object):
+    def __init__(self) -> None:
+        self.age = Histogram()
+        self.cacheAge = Histogram()
+
+
+class DataAgeTracer(object):
+    '''
+    How old each value is when it goes out on the wire.
+
+        age       since the value was last seen to change upstream, an ItemsChanged from the
+                  grid tracker or a blocking read returning a different value
+        cacheAge  since the value was last read from the grid service, how long the cache held it
+
+    Each reply records both for every upstream path its registers depend on, derived values count
+    through their inputs. A value that really is constant shows a growing age, so judge freshness
+    on paths that change every meter update, eg /Ac/Power.
+    '''
+
+    def __init__(self, datastore, reportPeriod: float = 60) -> None:
+        self.datastore = datastore
+        self.reportPeriod = reportPeriod
+        self.paths = {}
+        self.lastReport = time.time()
+
+    def pathAge(self, path: str) -> PathAge:
+        pathAge = self.paths.get(path)
+        if pathAge == None:
+            pathAge = PathAge()
+            self.paths[path] = pathAge
+        return pathAge
+
+    def onServed(self, paths: tuple, wireTime: float) -> None:
+        '''
+        A reply built from paths finished leaving the UART at wireTime.
+        '''
+        pathsSeen = self.datastore.pathsSeen
+        valueFetched = self.datastore.valueFetched
+        for path in paths:
+            seen = pathsSeen.get(path)
+            if seen != None:
+                pathAge = self.paths.get(path)
+                if pathAge == None:
+                    pathAge = self.pathAge(path)
+                pathAge.age.record(wireTime - seen)
+                fetched = valueFetched.get(path)
+                if fetched != None:
+                    pathAge.cacheAge.record(wireTime - fetched)
+        if wireTime - self.lastReport > self.reportPeriod:
+            self.lastReport = wireTime
+            log.info(self.compactSummary())
+
+    def summary(self) -> dict:
+        return {path: {'age': pathAge.age.summary(), 'cacheAge': pathAge.cacheAge.summary()}
+            for path, pathAge in sorted(self.paths.items())}
+
+    def compactSummary(self) -> str:
+        return 'age ' + ' | '.join(f'{path} p50:{a.age.percentile(50):.2f}s p90:{a.age.percentile(90):.2f}s '
+            f'cache p90:{a.cacheAge.percentile(90):.2f}s' for path, a in sorted(self.paths.items()))
@@ -1,8 +1,10 @@
-import struct
 import dbus
 import time
 import os
+import threading
 from typing import Callable, ValuesView
+from meterprofiles import loadProfiles, Profile, Plan, Derived, PROFILE_DIR
+from stats import Histogram
 import logging
 log = logging.getLogger(__name__)
 
@@ -100,48 +102,128 @@ class BusItemTracker(object):
     def isDead(self) -> bool:
         return ((time.time() - self.lastChange) > 30)
 
+class EnergyIntegrator(object):
+    '''
+    Smooths an upstream energy counter that only changes in coarse steps.
+    Power is integrated locally between upstream changes, when the upstream counter
+    changes the integration is re-anchored to it. The value returned never goes backwards,
+    if the integration overshot it is held until the new anchor catches up.
+    @param sign 1 to integrate import (positive power), -1 for export
+    @param maxGap longest interval in seconds integrated with one pair of power samples
+    '''
+
+    def __init__(self, sign: int, maxGap: float = 5.0) -> None:
+        self.sign = sign
+        self.maxGap = maxGap
+        self.anchor = None
+        self.integrated = 0.0
+        self.served = None
+        self.lastPower = None
+        self.lastTime = None
+
+    def addPower(self, power: float, now: float) -> None:
+        if self.lastTime != None and now > self.lastTime:
+            # trapezoid, only power flowing in this direction counts
+            mean = self.sign*(power + self.lastPower)/2
+            if mean > 0:
+                self.integrated += mean*min(now - self.lastTime, self.maxGap)/3600000.0
+        self.lastPower = power
+        self.lastTime = now
+
+    def read(self, upstream):
+        '''
+        The smoothed counter in kWh given the latest upstream value.
+        '''
+        if upstream == None:
+            return self.served
+        if upstream != self.anchor:
+            self.anchor = upstream
+            self.integrated = 0.0
+        value = self.anchor + self.integrated
+        if self.served != None and value < self.served:
+            value = self.served
+        self.served = value
+        return value
+
+
 class SD230DataStore(object):
     '''
     Watches the dbus to pack a map with values.
     '''
 
-    dbusMap = {
-        0x0000: '/Ac/Voltage',
-        0x0006: '/Ac/Current',
-        0x000c: '/Ac/Power',
-        0x0012: '/Ac/ApparentPower',
-        0x0018: '/Ac/ReactivePower',
-        0x001E: '/Ac/PowerFactor',
-        0x0046: '/Ac/Frequency',
-        0x0048: '/Ac/Energy/Forward', 
-        0x004a: '/Ac/Energy/Reverse', 
-        0x004c: '/Ac/Energy/ReactiveForward',
-        0x004e: '/Ac/Energy/ReactiveReverse',
-        0x0156: '/Ac/Energy/Total',
-        0x0158: '/Ac/Energy/ReactiveTotal', 
+    # energy counters smoothed by integrating powerPath, with the direction of power they count
+    powerPath = '/Ac/Power'
+    energyCounters = {
+        '/Ac/Energy/Forward': 1,
+        '/Ac/Energy/Reverse': -1,
     }
 
-    def __init__(self) -> None:
+    def __init__(self, valueTTL: float = 0.1, profileDir: str = PROFILE_DIR, missingRetry: float = 60,
+            smoothEnergy: bool = True, dbusConn=None, clock: Callable = time.time) -> None:
+        '''
+        @param valueTTL seconds a value fetched with a blocking call is reused for,
+            so several servers reading the same registers dont each make a DBus call.
+        @param profileDir directory of meter profiles that can be bound to a port
+        @param missingRetry seconds before a path that does not exist on the grid service is tried again
+        @param smoothEnergy integrate power between updates of the energy counters, see EnergyIntegrator
+        @param dbusConn the bus to find the grid service on, None for the system bus, or anything with
+            list_names and call_blocking to run without DBus
+        @param clock the time used for value ages and TTLs, so a soak can run on a simulated clock
+        '''
         super().__init__()
-        self.dbusConn = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
+        self.profileDir = profileDir
+        self.profiles = loadProfiles(profileDir)
+        self.paths = set()
+        for profile in self.profiles.values():
+            self.paths.update(profile.paths)
+        if dbusConn == None:
+            dbusConn = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
+        self.dbusConn = dbusConn
+        self.clock = clock
         self.dbusValues = {}
+        self.valueFetched = {}
+        self.valueTTL = valueTTL
+        self.missingRetry = missingRetry
+        self.missingPaths = {}
+        self.integrators = {}
+        if smoothEnergy:
+            for path, sign in self.energyCounters.items():
+                self.integrators[path] = EnergyIntegrator(sign)
         self.pathsSeen = {}
         self.useServiceTracker = False
         self.gridTracker = None
-        dbusNames = self.dbusConn.list_names()
-        self.gridServiceName = None
-        for x in dbusNames:
-            s = str(x)
-            if s.startswith('com.victronenergy.grid'):
-                self.gridServiceName = s
+        # set by the health supervisor, the next port thread through checkInit reconnects
+        self.reconnectPending = False
+        self.reconnectLock = threading.Lock()
+        # blocking DBus call times and outcomes, watched by the health supervisor
+        self.dbusCallTime = Histogram()
+        self.dbusCalls = 0
+        self.dbusFailures = 0
+        self.gridServiceName = self.findGridService()
         log.info(f' grid service name {self.gridServiceName}')
         if self.gridServiceName == None:
             raise Exception('Cant find grid service name in dbus')
 
+    def findGridService(self) -> str:
+        gridServiceName = None
+        for x in self.dbusConn.list_names():
+            s = str(x)
+            if s.startswith('com.victronenergy.grid'):
+                gridServiceName = s
+        return gridServiceName
+
 
 
 
     def checkInit(self) -> None:
+        if self.reconnectPending and self.reconnectLock.acquire(False):
+            # only one of the port threads sharing the datastore carries it out
+            try:
+                if self.reconnectPending:
+                    self.reconnectPending = False
+                    self.reconnect()
+            finally:
+                self.reconnectLock.release()
         # create watches on the dbus for each of the entries in the dbus map
         self.createServiceTracker()
 
@@ -156,6 +238,24 @@ class SD230DataStore(object):
 
 
 
+    def reconnect(self) -> None:
+        '''
+        Drop the tracker and everything learnt about the grid service, then find the service again,
+        it may have restarted under another name. Run from a port thread, the caches are replaced
+        rather than cleared so other ports mid request see either the old or the new one.
+        '''
+        start = time.perf_counter()
+        self.deleteServiceTracker()
+        self.valueFetched = {}
+        self.missingPaths = {}
+        gridServiceName = self.findGridService()
+        if gridServiceName != None:
+            if gridServiceName != self.gridServiceName:
+                log.info(f' grid service name {gridServiceName}')
+            self.gridServiceName = gridServiceName
+        self.createServiceTracker()
+        log.warning(f'Reconnected to {self.gridServiceName} in {(time.perf_counter()-start)*1000:.1f}ms')
+
     def createServiceTracker(self) -> None:
         '''
         Create a Dbus tracker to recieve changes.
@@ -171,9 +271,10 @@ class SD230DataStore(object):
                     and self.gridServiceName != None):
                     self.gridTracker = BusItemTracker(self.dbusConn, self.gridServiceName, '/', self.gridChanged)
                     # get the inital values
-                    self.dbusValues = self.gridTracker.getInitialValues(self.dbusConn, self.dbusMap.values())
-                    for path in self.dbusMap.values():
-                        self.pathsSeen[path] = time.time()
+                    self.dbusValues = self.gridTracker.getInitialValues(self.dbusConn, self.paths)
+                    now = self.clock()
+                    for path in self.paths:
+                        self.pathsSeen[path] = now
 
                 else:
                     log.error("No grid tracker created ")
@@ -184,54 +285,128 @@ class SD230DataStore(object):
         When the dbus value changes update the local copy
         to be used when packing a register.
         '''
-        now = time.time()
+        now = self.clock()
         for path, value in values.items():
-            if path in self.dbusMap.values():
-                log.info(f" Update {path} value {value} age {now-self.pathsSeen[path]}")
-                self.dbusValues[path] = value
-                self.pathsSeen[path] = now
-
-    def packValue(self, address: int, offset: int, message: list) -> int:
-        '''
-        Pack the message with the register as int16 and return the 
-        number of registers that were packed. registers are always uint16 stored
-        bigendian '>2H' 
-        the SDM230 uses 32 bit floats in IEE 754 format
-        '''
-        register = address+offset
-        path = None
-        if register in self.dbusMap:
-            # pack 32 bit floats in IEE 754 format.
-            path = self.dbusMap[register]
-            value = None
-            if self.useServiceTracker:
-                if path in self.dbusValues:
-                    value = float(self.dbusValues[path])
+            if path in self.paths:
+                log.info(f" Update {path} value {value} age {now-self.pathsSeen.get(path, now)}")
+                self.storeValue(path, value, now)
+
+    def setProfiles(self, profiles: dict, profileDir: str) -> None:
+        '''
+        Replace the profiles on a reload. The value cache is kept, paths only the old profiles
+        used stay known as a server keeps its old profile until it swaps between frames.
+        '''
+        paths = set(self.paths)
+        for profile in profiles.values():
+            paths.update(profile.paths)
+        self.paths = paths
+        self.profiles = profiles
+        self.profileDir = profileDir
+
+    def getProfile(self, name: str) -> Profile:
+        if name not in self.profiles:
+            raise ValueError(f'Unknown profile {name}, available {sorted(self.profiles)}')
+        return self.profiles[name]
+
+    def storeValue(self, path: str, value, now: float) -> None:
+        '''
+        Put a value into the cache, power is also fed to the energy integrators.
+        pathsSeen records when each value was last seen to change, the start of its data age.
+        '''
+        if self.dbusValues.get(path) != value:
+            self.pathsSeen[path] = now
+        self.dbusValues[path] = value
+        if path == self.powerPath and value != None:
+            for integrator in self.integrators.values():
+                integrator.addPower(float(value), now)
+
+    def getValue(self, path: str):
+        if self.useServiceTracker:
+            value = self.dbusValues.get(path)
+        else:
+            value = self.fetchValue(path)
+        if path in self.integrators:
+            return self.integrators[path].read(value)
+        return value
+
+    def readSource(self, source):
+        '''
+        Value of a plan or derived input, either an upstream path or a Derived.
+        '''
+        if source.__class__ is str:
+            return self.getValue(source)
+        return self.readDerived(source)
+
+    def readDerived(self, derived: Derived):
+        '''
+        The grid service value of a derived path if it publishes one, measured values are never
+        replaced, otherwise the value computed from its inputs.
+        '''
+        value = self.getValue(derived.path)
+        if value == None:
+            value = derived.read(self)
+        return value
+
+    def fetchValue(self, path: str):
+        '''
+        Get the value with a blocking call, reusing the last value if it is younger than valueTTL.
+        '''
+        start = self.clock()
+        if start - self.valueFetched.get(path, 0.0) < self.valueTTL:
+            return self.dbusValues[path]
+        retry = self.missingPaths.get(path)
+        if retry != None and start < retry:
+            return None
+        value = None
+        self.dbusCalls += 1
+        callStart = time.perf_counter()
+        try:
+            dbusValue = self.dbusConn.call_blocking(self.gridServiceName, path, VE_INTERFACE, 'GetValue', '', [])
+            log.debug(f'DBus Call took {time.perf_counter() - callStart} {dbusValue}')
+            if dbusValue != None:
+                value = float(dbusValue)
+                self.storeValue(path, value, start)
+                self.valueFetched[path] = start
+                self.missingPaths.pop(path, None)
+        except dbus.exceptions.DBusException:
+            self.dbusFailures += 1
+            # paths the grid service does not publish would otherwise cost a call and a log line per poll
+            if path not in self.missingPaths:
+                log.error(f'Cant get value on {self.gridServiceName}:{path}, retry in {self.missingRetry}s')
+            self.missingPaths[path] = start + self.missingRetry
+        self.dbusCallTime.record(time.perf_counter() - callStart)
+        return value
+
+    def packRegisters(self, profile: Profile, address: int, count: int, buffer: bytearray, offset: int = 0) -> Plan:
+        '''
+        Pack count registers starting at address into buffer at offset, registers are uint16
+        stored bigendian, values are encoded as defined by the profile, unmapped registers are zero.
+        Returns the plan used.
+        '''
+        plan = profile.plan(address, count)
+        buffer[offset:offset+plan.size] = plan.zeros
+        for byteOffset, path, encoder, derived in plan.entries:
+            if derived == None:
+                value = self.getValue(path)
             else:
-                try:
-                    start = time.time()
-                    dbusValue = self.dbusConn.call_blocking(self.gridServiceName, path, VE_INTERFACE, 'GetValue', '', [])
-                    log.debug(f'DBus Call took {time.time() - start} {dbusValue}')
-                    if dbusValue != None:
-                        value = float(dbusValue)
-                except dbus.exceptions.DBusException:
-                    log.error(f'Cant get value on {self.gridServiceName}:{path}')
+                value = self.readDerived(derived)
             if value != None:
-                packed = struct.unpack('>2H', struct.pack('>f', value))
-                log.debug(f'packed {register} {path} {value} as {packed}')
-                message.extend(packed)
+                encoder.pack_into(buffer, offset+byteOffset, float(value))
             else:
-                log.info(f'packed {register} {path} no value')
-                message.extend([0x00, 0x00])
-            return 2
-        else:
-            log.debug(f'skip {register} ')
-            message.extend([0x00])
-            return 1
+                log.debug(f'packed {address+byteOffset//2} {path} no value')
+        return plan
+
+    def readRegisters(self, address: int, count: int, profile: Profile) -> bytearray:
+        '''
+        Pack count registers starting at address, shared by all the servers.
+        '''
+        buffer = bytearray(count*2)
+        self.packRegisters(profile, address, count, buffer)
+        return buffer
 
-    def setValue(self, path: str, value: float) -> bool:
-        if path in self.dbusMap.values():
-            self.dbusValues[path] = value
+    def setValue(self, path: str, value: float, now: float = None) -> bool:
+        if path in self.paths:
+            self.storeValue(path, value, self.clock() if now == None else now)
             return True
         return False
 
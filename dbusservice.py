@@ -0,0 +1,134 @@
+import time
+import dbus
+import dbus.service
+from status import StatusCollector
+from stats import Histogram
+
+import logging
+log = logging.getLogger(__name__)
+
+
+VE_INTERFACE = "com.victronenergy.BusItem"
+
+
+def wrapValue(value):
+    '''
+    Python value to a DBus variant the way Venus services publish them, None is an empty array.
+    '''
+    if value == None:
+        return dbus.Array([], signature=dbus.Signature('i'), variant_level=1)
+    if isinstance(value, bool):
+        return dbus.Int32(value, variant_level=1)
+    if isinstance(value, int):
+        return dbus.Int64(value, variant_level=1)
+    if isinstance(value, float):
+        return dbus.Double(value, variant_level=1)
+    return dbus.String(str(value), variant_level=1)
+
+
+class BusItem(dbus.service.Object):
+    '''
+    One read only value at path.
+    '''
+    def __init__(self, bus, path: str, value, text: str) -> None:
+        super().__init__(bus, path)
+        self.value = value
+        self.text = text
+
+    @dbus.service.method(VE_INTERFACE, out_signature='v')
+    def GetValue(self):
+        return wrapValue(self.value)
+
+    @dbus.service.method(VE_INTERFACE, out_signature='v')
+    def GetText(self):
+        return dbus.String(self.text, variant_level=1)
+
+    @dbus.service.method(VE_INTERFACE, in_signature='v', out_signature='i')
+    def SetValue(self, value):
+        # not allowed, all the values are measurements
+        return 1
+
+
+class RootItem(dbus.service.Object):
+    '''
+    The service root, all values in one call and the ItemsChanged signal.
+    '''
+    def __init__(self, bus, service: 'StatusService') -> None:
+        super().__init__(bus, '/')
+        self.service = service
+
+    @dbus.service.method(VE_INTERFACE, out_signature='v')
+    def GetValue(self):
+        return dbus.Dictionary({path[1:]: wrapValue(item.value) for path, item in self.service.items.items()},
+            signature='sv', variant_level=1)
+
+    @dbus.service.method(VE_INTERFACE, out_signature='v')
+    def GetText(self):
+        return dbus.Dictionary({path[1:]: item.text for path, item in self.service.items.items()},
+            signature='ss', variant_level=1)
+
+    @dbus.service.method(VE_INTERFACE, out_signature='a{sa{sv}}')
+    def GetItems(self):
+        return {path: {'Value': wrapValue(item.value), 'Text': item.text} for path, item in self.service.items.items()}
+
+    @dbus.service.signal(VE_INTERFACE, signature='a{sa{sv}}')
+    def ItemsChanged(self, changes):
+        pass
+
+
+class StatusService(object):
+    '''
+    Publishes the emulators own counters and latencies as a Venus style service, on the bus the
+    datastore uses. publish() is called from the main loop every period seconds, it collects,
+    updates the BusItems and sends one ItemsChanged with only the paths that changed, so there
+    is at most one signal per period whatever the request rate and the port threads never touch DBus.
+    '''
+
+    def __init__(self, bus, collector: StatusCollector, serviceName: str = 'com.victronenergy.sdm230device') -> None:
+        self.bus = bus
+        self.collector = collector
+        self.serviceName = serviceName
+        self.items = {}
+        self.values = {}
+        self.signals = 0
+        self.publishTime = Histogram()
+        self.root = RootItem(bus, self)
+        self.update(collector.collect())
+        try:
+            self.busName = dbus.service.BusName(serviceName, bus)
+        except dbus.exceptions.DBusException:
+            # eg the bus policy does not allow the name, leave nothing exported behind
+            self.close()
+            raise
+        log.info(f'Status published as {serviceName}, {len(self.items)} paths')
+
+    def close(self) -> None:
+        for item in self.items.values():
+            item.remove_from_connection()
+        self.root.remove_from_connection()
+        self.items = {}
+
+    def update(self, values: dict) -> dict:
+        changes = StatusCollector.changes(self.values, values)
+        for path, value in changes.items():
+            text = StatusCollector.text(path, value)
+            item = self.items.get(path)
+            if item == None:
+                self.items[path] = BusItem(self.bus, path, value, text)
+            else:
+                item.value = value
+                item.text = text
+        self.values = values
+        return changes
+
+    def publish(self) -> bool:
+        start = time.perf_counter()
+        changes = self.update(self.collector.collect())
+        if changes:
+            self.root.ItemsChanged(dbus.Dictionary(
+                {path: dbus.Dictionary({'Value': wrapValue(value), 'Text': self.items[path].text}, signature='sv')
+                    for path, value in changes.items()}, signature='sa{sv}'))
+            self.signals += 1
+        self.publishTime.record(time.perf_counter() - start)
+        # keep the GLib timeout running
+        return True
@@ -0,0 +1,144 @@
+import faulthandler
+import os
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class HealthSupervisor(object):
+    '''
+    Watches service level indicators rather than just liveness, the Watchdog only sees a thread
+    that stopped, not one that is answering slowly or not hearing any requests.
+
+        response time p99 of each port over the last check period
+        blocking DBus call time p90 and failure rate, and the grid tracker when it is used
+        time since the last valid request for our unit on each port
+
+    Each symptom has its own ladder of repairs, taken one step per check while it lasts.
+    Slow replies reset that port's scanner, then reopen its serial port, then exit for the
+    supervisor to restart the process. DBus problems find the grid service again, then exit.
+    A quiet line reopens the port once and is then only reported, a night without polls is
+    not a fault and a restart cant make the master poll. A symptom that clears resets its ladder.
+    Repairs are carried out by the port threads between frames, check() only requests them.
+    Call check() every checkPeriod seconds from the main loop.
+    '''
+
+    SCANNER = 1
+    DBUS = 2
+    SERIAL = 3
+    EXIT = 4
+    LEVELS = {0: 'none', SCANNER: 'reset scanner', DBUS: 'reconnect dbus', SERIAL: 'reopen serial', EXIT: 'exit'}
+    # the next repair for each symptom given the last one taken, 0 is none yet
+    LADDERS = {
+        'slow': {0: SCANNER, SCANNER: SERIAL, SERIAL: EXIT, EXIT: EXIT},
+        'dbus': {0: DBUS, DBUS: EXIT, EXIT: EXIT},
+        'quiet': {0: SERIAL, SERIAL: SERIAL},
+    }
+
+    def __init__(self, servers: list, datastore, checkPeriod: float = 10,
+            responseP99: float = 0.1,
+            dbusP90: float = 0.1,
+            dbusFailureRate: float = 0.5,
+            frameTimeout: float = 120,
+            minSamples: int = 10) -> None:
+        """
+        :param servers: the ModbusRTUSerialServers to watch
+        :param checkPeriod: seconds between checks, the window the percentiles are taken over
+        :param responseP99: seconds, limit on the 99th percentile request to reply time
+        :param dbusP90: seconds, limit on the 90th percentile blocking DBus call time
+        :param dbusFailureRate: limit on the fraction of DBus calls that fail
+        :param frameTimeout: seconds without a valid request for our unit
+        :param minSamples: percentiles and rates from fewer samples are not judged
+        """
+        self.servers = servers
+        self.datastore = datastore
+        self.checkPeriod = checkPeriod
+        self.responseP99 = responseP99
+        self.dbusP90 = dbusP90
+        self.dbusFailureRate = dbusFailureRate
+        self.frameTimeout = frameTimeout
+        self.minSamples = minSamples
+        self.level = 0
+        self.escalations = 0
+        self.problems = []
+        # (symptom, server name) to (last repair, unhealthy since)
+        self.ladders = {}
+        self.responseTimes = {server.name: server.responseTime.copy() for server in servers}
+        self.dbusCallTime = datastore.dbusCallTime.copy()
+        self.dbusCalls = datastore.dbusCalls
+        self.dbusFailures = datastore.dbusFailures
+
+    def evaluate(self, now: float) -> dict:
+        '''
+        Problems found in the window since the last call, keyed by (symptom, server name).
+        '''
+        found = {}
+        for server in self.servers:
+            current = server.responseTime.copy()
+            window = current.since(self.responseTimes[server.name])
+            self.responseTimes[server.name] = current
+            if window.count >= self.minSamples and window.percentile(99) > self.responseP99:
+                found[('slow', server.name)] = f'{server.name} response p99 {window.percentile(99)*1000:.1f}ms'
+            age = now - server.lastValidFrame
+            if age > self.frameTimeout:
+                found[('quiet', server.name)] = f'{server.name} no valid frame for {age:.0f}s'
+        current = self.datastore.dbusCallTime.copy()
+        window = current.since(self.dbusCallTime)
+        self.dbusCallTime = current
+        calls = self.datastore.dbusCalls - self.dbusCalls
+        failures = self.datastore.dbusFailures - self.dbusFailures
+        self.dbusCalls += calls
+        self.dbusFailures += failures
+        dbusProblems = []
+        if window.count >= self.minSamples and window.percentile(90) > self.dbusP90:
+            dbusProblems.append(f'dbus p90 {window.percentile(90)*1000:.1f}ms')
+        if calls >= self.minSamples and failures > calls*self.dbusFailureRate:
+            dbusProblems.append(f'dbus failures {failures}/{calls}')
+        tracker = self.datastore.gridTracker
+        if self.datastore.useServiceTracker and (not tracker or tracker.isDead()):
+            dbusProblems.append('grid tracker dead')
+        if dbusProblems:
+            found[('dbus', None)] = ', '.join(dbusProblems)
+        return found
+
+    def escalate(self, key: tuple, problem: str, now: float) -> None:
+        symptom, name = key
+        last, since = self.ladders.get(key, (0, now))
+        level = self.LADDERS[symptom][last]
+        self.ladders[key] = (level, since)
+        self.level = max(self.level, level)
+        if symptom == 'quiet' and last != 0:
+            # reopened once already, the master may just not be polling
+            return
+        self.escalations += 1
+        log.warning(f'Health {problem}, unhealthy for {now - since:.0f}s, {self.LEVELS[level]}')
+        if level == self.EXIT:
+            self.exit()
+        elif level == self.DBUS:
+            # the port threads read the value cache, so one of them reconnects between frames
+            self.datastore.reconnectPending = True
+        else:
+            # carried out by the port's own thread, it logs the time taken
+            for server in self.servers:
+                if server.name == name:
+                    server.repair = 'scanner' if level == self.SCANNER else 'serial'
+
+    def exit(self) -> None:
+        log.error('Health repairs failed, exiting')
+        faulthandler.dump_traceback()
+        os._exit(1)
+
+    def check(self) -> bool:
+        now = time.time()
+        found = self.evaluate(now)
+        self.problems = list(found.values())
+        self.level = 0
+        for key in list(self.ladders):
+            if key not in found:
+                level, since = self.ladders.pop(key)
+                log.info(f'Health {key[0]} {key[1] or ""} recovered at {self.LEVELS[level]} after {now - since:.0f}s')
+        for key, problem in found.items():
+            self.escalate(key, problem, now)
+        # keep the GLib timeout running
+        return True
@@ -16,8 +16,17 @@ import threading
 
 
 import watchdog
+from health import HealthSupervisor
+from profiler import SamplingProfiler
+from soak import Soak, parseDuration
+from status import StatusCollector
+from dbusservice import StatusService
 
 from modbus import ModbusRTUSerialServer
+from modbustcp import ModbusTCPServer
+from busanalyser import BusAnalyser
+from dataage import DataAgeTracer
+from config import Binding, ConfigReloader, loadConfig, applyLogLevels
 from datastore import SD230DataStore
 
 
@@ -36,29 +45,87 @@ __all__ = ['NAME', 'VERSION']
 
 
 class Client:
-    def __init__(self, tty: str, rate: int) -> None:
-        self.tty = tty
+    def __init__(self, bindings: list, lowLatency: bool = False, tcpPort: int = None,
+            analyse: bool = False, analyseDump: str = None, healthPeriod: float = 0,
+            profileDir: str = '/data', statusPeriod: float = 0, traceAge: bool = False,
+            echo: bool = False, config: dict = None, configFile: str = None, rate: int = 9600) -> None:
+        self.bindings = bindings
+        self.config = config if config != None else {}
+        self.configFile = configFile
         self.rate = rate
+        self.reloader = None
+        self.echo = echo
+        self.traceAge = traceAge
+        self.ageTracer = None
+        self.statusPeriod = statusPeriod
+        self.status = None
+        self.profiler = SamplingProfiler(profileDir)
+        self.healthPeriod = healthPeriod
+        self.health = None
+        self.lowLatency = lowLatency
+        self.tcpPort = tcpPort
+        self.analyse = analyse
+        self.analyseDump = analyseDump
+        self.modbusServers = []
+        self.threads = []
+        self.tcpServer = None
         self.rss = 0
         self.last_rss_change = 0
         self.watchdog = None
-        if tty:
+        if any(binding.tty for binding in bindings):
             self.watchdog = watchdog.Watchdog()
 
     def init(self) -> None:
-        self.datastore = SD230DataStore()
+        # one DBus connection and value cache shared by every port
+        self.datastore = SD230DataStore(**{key: self.config[key] for key in ('valueTTL', 'missingRetry', 'profileDir')
+            if key in self.config})
         self.datastore.checkInit()
-        self.modbusServer = ModbusRTUSerialServer(self.datastore, device=self.tty, baudrate=self.rate)
+        if self.traceAge:
+            self.ageTracer = DataAgeTracer(self.datastore)
+        for binding in self.bindings:
+            log.info(f'Serving {binding}')
+            analyser = None
+            if self.analyse:
+                dumpFile = self.analyseDump
+                if dumpFile and len(self.bindings) > 1:
+                    dumpFile = f'{dumpFile}.{os.path.basename(str(binding.tty))}'
+                analyser = BusAnalyser(binding.rate, dumpFile=dumpFile)
+            self.modbusServers.append(ModbusRTUSerialServer(self.datastore, device=binding.tty,
+                unit=binding.unit,
+                profile=binding.profile,
+                baudrate=binding.rate,
+                lowLatency=self.lowLatency,
+                analyser=analyser,
+                ageTracer=self.ageTracer,
+                echo=self.echo))
+        if self.tcpPort != None:
+            self.tcpServer = ModbusTCPServer(self.datastore, port=self.tcpPort, unit=self.bindings[0].unit, profile=self.bindings[0].profile,
+                baudrate=self.bindings[0].rate)
         if self.watchdog:
-            self.watchdog.start()
+            self.watchdog.start([modbusServer.name for modbusServer in self.modbusServers])
+        if self.healthPeriod > 0:
+            self.health = HealthSupervisor(self.modbusServers, self.datastore, self.healthPeriod)
+        if self.statusPeriod > 0:
+            collector = StatusCollector(self.modbusServers, self.datastore, self.health, NAME, VERSION, self.ageTracer)
+            try:
+                self.status = StatusService(self.datastore.dbusConn, collector)
+            except dbus.exceptions.DBusException as e:
+                # the emulator itself does not need it, so carry on serving without
+                log.error(f'Status service not published, {e}')
+        if self.configFile != None:
+            self.reloader = ConfigReloader(self.configFile, self.modbusServers, self.datastore, self.rate,
+                self.status.collector if self.status else None)
 
 
     def destroy(self) -> None:
-        self.modbusServer.close()
+        for modbusServer in self.modbusServers:
+            modbusServer.close()
+        if self.tcpServer:
+            self.tcpServer.close()
         self.datastore.destroy()
 
 
-    def check_rss(self) -> None:
+    def check_rss(self) -> bool:
         rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
         if rss != self.rss:
             now = time.time()
@@ -73,13 +140,16 @@ class Client:
             if self.rss > 32000:
                 log.error(f'RSS reached limit, exiting')
                 sys.exit()
+        # keep the GLib timeout running
+        return True
 
 
     def update_timer(self) -> bool:
         try:
-            self.modbusServer.handle()
-            if self.watchdog:
-                self.watchdog.update()
+            for modbusServer in self.modbusServers:
+                modbusServer.handle()
+                if self.watchdog:
+                    self.watchdog.update(modbusServer.name)
         except:
             log.error('Uncaught exception in update')
             traceback.print_exc()
@@ -88,12 +158,12 @@ class Client:
 
 
 
-    def run(self):
+    def run(self, modbusServer: ModbusRTUSerialServer):
         while self.running:
             try:
-                self.modbusServer.handle(threaded=True)
+                modbusServer.handle(threaded=True)
                 if self.watchdog:
-                    self.watchdog.update()
+                    self.watchdog.update(modbusServer.name)
             except:
                 log.error('Uncaught exception in update')
                 traceback.print_exc()
@@ -101,15 +171,33 @@ class Client:
 
 
 
+    def runTcp(self):
+        while self.running:
+            try:
+                self.tcpServer.handle()
+            except:
+                log.error('Uncaught exception in tcp update')
+                traceback.print_exc()
+
+
     def start(self):
         self.stop()
-        self.thread = threading.Thread(target=self.run)
         self.running = True
-        self.thread.start()
+        # each port has its own thread as reads block, framing state is per server
+        for modbusServer in self.modbusServers:
+            self.threads.append(threading.Thread(target=self.run, args=(modbusServer,), name=modbusServer.name))
+        if self.tcpServer:
+            self.threads.append(threading.Thread(target=self.runTcp, name='tcp'))
+        for thread in self.threads:
+            thread.start()
+        # the main thread runs the GLib loop
+        self.profiler.watch('glib', threading.main_thread().ident)
+        for thread in self.threads:
+            self.profiler.watch(thread.name, thread.ident)
 
     def stop(self):
         self.running = False
-        self.thread = None
+        self.threads = []
 
 
 
@@ -124,6 +212,36 @@ def main():
     parser.add_argument('-m', '--mode', choices=['ascii', 'rtu'], default='rtu')
     parser.add_argument('-r', '--rate', type=int, default=9600) 
     parser.add_argument('-s', '--serial')
+    parser.add_argument('-b', '--bind', action='append', default=[],
+                        help='serve a port DEVICE[:UNIT[:PROFILE[:RATE]]], may be repeated')
+    parser.add_argument('--tcp', type=int, help='also serve Modbus TCP on this port, with the unit and profile of the first --bind only, '
+                        'it is not watched by the health checks or the watchdog and a reload does not change it')
+    parser.add_argument('--analyse', help='classify all traffic on the bus and log a summary every minute',
+                        action='store_true')
+    parser.add_argument('--analyse-dump', help='also write the bus analysis as json to this file',
+                        default='/data/sdm230device-bus.json')
+    parser.add_argument('--low-latency', help='set the kernel low latency flag on the serial port',
+                        action='store_true')
+    parser.add_argument('--echo', help='the RS485 adapter echoes our transmit, drop the echo and count collisions',
+                        action='store_true')
+    parser.add_argument('--config', help='json settings applied over the command line, read again on SIGHUP')
+    parser.add_argument('--health-period', type=float, default=0,
+                        help='seconds between health checks that repair a degraded service, 0 to disable')
+    parser.add_argument('--profile-dir', default='/data',
+                        help='SIGUSR2 starts and stops sampling the threads, the collapsed stacks are written here')
+    parser.add_argument('--status-period', type=float, default=0,
+                        help='seconds between updates of the com.victronenergy.sdm230device status service, 0 to disable')
+    parser.add_argument('--trace-age', help='record how old each served value is, logged every minute and published',
+                        action='store_true')
+    parser.add_argument('--soak', type=parseDuration,
+                        help='endurance run of this simulated duration, eg 4w, against the first binding then exit')
+    parser.add_argument('--soak-csv', default='/data/sdm230device-soak.csv')
+    parser.add_argument('--soak-period', type=parseDuration, default=3600,
+                        help='simulated seconds between CSV rows')
+    parser.add_argument('--soak-speed', type=float, default=0,
+                        help='simulated seconds per real second, 0 for as fast as possible')
+    parser.add_argument('--soak-dbus', help='read values from the grid service rather than a fake source',
+                        action='store_true')
 
     args = parser.parse_args()
 
@@ -142,14 +260,37 @@ def main():
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     mainloop = GLib.MainLoop()
 
-    tty=None
-    if args.serial:
-        tty = args.serial 
-    client = Client(tty, args.rate)
+    config = {}
+    if args.config:
+        config = loadConfig(args.config)
+        applyLogLevels(config.get('logLevels', {}))
+    bindings = [Binding.parse(bind, args.rate) for bind in config.get('bind', args.bind)]
+    if args.serial or len(bindings) == 0:
+        bindings.insert(0, Binding(args.serial, rate=args.rate))
+
+    if args.soak:
+        soak = Soak(args.soak, args.soak_csv, args.soak_period, args.soak_speed,
+            unit=bindings[0].unit, profile=bindings[0].profile, baudrate=bindings[0].rate,
+            fakeSource=not args.soak_dbus)
+        soak.run()
+        return
+    client = Client(bindings, config.get('lowLatency', args.low_latency), args.tcp, args.analyse, args.analyse_dump,
+        args.health_period, args.profile_dir, args.status_period, config.get('traceAge', args.trace_age),
+        config.get('echo', args.echo), config, args.config, args.rate)
     client.init()
 
     client.start()
 
+    if client.health:
+        GLib.timeout_add(int(args.health_period*1000), client.health.check)
+    if client.status:
+        GLib.timeout_add(int(args.status_period*1000), client.status.publish)
+
+    # delivered by the main loop, a python signal handler would wait until the loop next runs python code
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR2, client.profiler.toggle)
+    if client.reloader:
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGHUP, client.reloader.reload)
+
     # non threaded operation, GLib.timeout_add(10, client.update_timer)
 
     GLib.timeout_add(1000, client.check_rss)
@@ -0,0 +1,211 @@
+import json
+import math
+import os
+import struct
+
+import logging
+log = logging.getLogger(__name__)
+
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+
+# Register encoders, the SDM meters use 32 bit IEE 754 floats, big endian over 2 registers.
+ENCODERS = {
+    'f32': struct.Struct('>f'),
+    'u32': struct.Struct('>I'),
+}
+
+
+def powerFactor(p: float, s: float) -> float:
+    if s == 0:
+        return 1.0
+    return max(-1.0, min(1.0, p/s))
+
+# Functions available to derived values, called with the input values in order.
+DERIVATIONS = {
+    'sum': lambda *values: sum(values),
+    'apparent': lambda v, i: abs(v*i),
+    # the magnitude from the power triangle, unsigned as V, I and P cant tell inductive from capacitive,
+    # a meter measures the sign itself and it does not follow the sign of P or PF
+    'reactive': lambda v, i, p: math.sqrt(max((v*i)**2 - p*p, 0.0)),
+    'powerfactor': powerFactor,
+    'linetoline': lambda a, b: math.sqrt(a*a + b*b + a*b),
+}
+
+
+def parseAddress(value) -> int:
+    '''
+    Addresses in profile files may be ints or strings like "0x0156".
+    '''
+    if isinstance(value, str):
+        return int(value, 0)
+    return int(value)
+
+
+class Derived(object):
+    '''
+    A value computed from other values in the cache, used when the grid service does not publish
+    the path itself, see SD230DataStore.readDerived. Inputs are upstream paths or other Derived values
+    of the same profile. The result is kept and only recomputed when an input changes, if any input
+    is missing the value is None.
+    '''
+    def __init__(self, path: str, fn: str, inputs: list) -> None:
+        if fn not in DERIVATIONS:
+            raise ValueError(f'Derived {path} unknown function {fn}')
+        self.path = path
+        self.fn = DERIVATIONS[fn]
+        self.inputs = inputs
+        # (inputs, value) replaced in one assignment, the RTU and TCP threads share profiles
+        # and must never see new inputs next to an old value
+        self.state = (None, None)
+        self.computeCount = 0
+
+    def read(self, datastore):
+        values = tuple(datastore.readSource(source) for source in self.inputs)
+        state = self.state
+        if values != state[0]:
+            state = (values, None if None in values else self.fn(*values))
+            self.state = state
+            self.computeCount = self.computeCount + 1
+        return state[1]
+
+    def __str__(self) -> str:
+        return self.path
+
+
+class Plan(object):
+    '''
+    The precompiled layout of one requested register range.
+    entries is a list of (byte offset, path, encoder, derived) so serving the range is a walk over the list,
+    derived is None for values fetched from DBus. Registers not covered by an entry are zero.
+    '''
+    def __init__(self, address: int, count: int, entries: list) -> None:
+        self.address = address
+        self.count = count
+        self.size = count*2
+        self.zeros = bytes(self.size)
+        self.entries = entries
+        # the upstream paths the range depends on, directly or through the inputs of derived values
+        paths = []
+        sources = [derived if derived != None else path for o, path, e, derived in entries]
+        while sources:
+            source = sources.pop(0)
+            if source.__class__ is not str:
+                sources.extend(source.inputs)
+                source = source.path
+            if source not in paths:
+                paths.append(source)
+        self.paths = tuple(paths)
+
+    def __str__(self) -> str:
+        return f'{self.address}:{self.count} {[(o, p) for o, p, e, d in self.entries]}'
+
+
+class Profile(object):
+    '''
+    A meter register layout, loaded from a json file in the profiles directory.
+
+        {
+            "description": "...",
+            "registers": [ {"address": "0x0000", "path": "/Ac/Voltage", "encoding": "f32"}, ...],
+            "blocks": [ ["0x0000", 18], ...],
+            "derived": { "/Ac/ApparentPower": {"fn": "apparent", "inputs": ["/Ac/Voltage", "/Ac/Current"]}, ...},
+            "holding": [ {"address": "0x0014", "setting": "unit"}, {"address": "0x000a", "value": 1}, ...],
+            "holdingBlocks": [ ["0x0000", 32], ...]
+        }
+
+    encoding defaults to f32. The blocks are the ranges the master is known to poll, they are
+    compiled when the profile is loaded, other ranges are compiled on first use.
+    Paths listed in derived are computed from their inputs, see DERIVATIONS, and never fetched.
+    Holding registers are read only configuration, either a fixed value or a setting of the port
+    serving the profile, optionally translated by a "map" eg baud rate to the meters code.
+    '''
+
+    # limits memory if a master scans the address space
+    maxPlans = 256
+
+    def __init__(self, name: str, definition: dict) -> None:
+        self.name = name
+        self.description = definition.get('description', name)
+        self.registers = {}
+        for register in definition['registers']:
+            address = parseAddress(register['address'])
+            encoding = register.get('encoding', 'f32')
+            if encoding not in ENCODERS:
+                raise ValueError(f'Profile {name} register {address} unknown encoding {encoding}')
+            self.registers[address] = (register['path'], ENCODERS[encoding])
+        self.derived = {}
+        for path, derivation in definition.get('derived', {}).items():
+            self.derived[path] = Derived(path, derivation['fn'], derivation['inputs'])
+        # resolve inputs now all derived values exist, anything else is an upstream path
+        for derived in self.derived.values():
+            derived.inputs = [self.derived.get(path, path) for path in derived.inputs]
+        # derived paths are still asked for upstream, they are only computed when missing there
+        self.paths = set(path for path, encoder in self.registers.values())
+        for derived in self.derived.values():
+            self.paths.update(source for source in derived.inputs if isinstance(source, str))
+        self.plans = {}
+        for address, count in definition.get('blocks', []):
+            self.plan(parseAddress(address), count)
+        self.holding = definition.get('holding', [])
+        self.holdingBlocks = [(parseAddress(address), count) for address, count in definition.get('holdingBlocks', [])]
+
+    def compileHolding(self, settings: dict) -> list:
+        '''
+        Build the holding register blocks for a port with the given settings
+        eg {'unit': 2, 'baudrate': 9600}, returns a list of (address, count, bytes).
+        '''
+        blocks = []
+        for address, count in self.holdingBlocks:
+            block = bytearray(count*2)
+            for register in self.holding:
+                offset = parseAddress(register['address']) - address
+                encoder = ENCODERS[register.get('encoding', 'f32')]
+                if offset < 0 or offset*2 + encoder.size > len(block):
+                    continue
+                if 'setting' in register:
+                    value = settings[register['setting']]
+                    if 'map' in register:
+                        if str(value) not in register['map']:
+                            log.warning(f'{self.name} holding {register["address"]} has no code for {value}')
+                            continue
+                        value = register['map'][str(value)]
+                else:
+                    value = register['value']
+                encoder.pack_into(block, offset*2, value)
+            blocks.append((address, count, bytes(block)))
+        return blocks
+
+    def compile(self, address: int, count: int) -> Plan:
+        entries = []
+        end = address + count
+        for register in sorted(self.registers):
+            path, encoder = self.registers[register]
+            # values straddling either end of the range are left as zero
+            if register >= address and register + encoder.size//2 <= end:
+                entries.append(((register - address)*2, path, encoder, self.derived.get(path)))
+        return Plan(address, count, entries)
+
+    def plan(self, address: int, count: int) -> Plan:
+        key = (address << 16) | count
+        plan = self.plans.get(key)
+        if plan == None:
+            plan = self.compile(address, count)
+            if len(self.plans) < self.maxPlans:
+                self.plans[key] = plan
+            log.debug(f'{self.name} compiled {plan}')
+        return plan
+
+
+def loadProfiles(directory: str = PROFILE_DIR) -> dict:
+    '''
+    Load and compile every profile in the directory, keyed by file name without .json
+    '''
+    profiles = {}
+    for fileName in sorted(os.listdir(directory)):
+        if fileName.endswith('.json'):
+            name = fileName[:-5]
+            with open(os.path.join(directory, fileName)) as f:
+                profiles[name] = Profile(name, json.load(f))
+            log.info(f'Loaded profile {name} {profiles[name].description}')
+    return profiles
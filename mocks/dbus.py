@@ -20,9 +20,21 @@ class UInt64:
 class Double:
 	pass
 
-class SessionBus(object):
-	def __init__(self) -> None:
+class exceptions:
+	class DBusException(Exception):
 		pass
-class SystemBus(object):
+
+class SessionBus(object):
 	def __init__(self) -> None:
-		pass
\ No newline at end of file
+		self.values = {}
+
+	def list_names(self):
+		return ['com.victronenergy.grid.mock']
+
+	def call_blocking(self, service, path, interface, method, signature, args):
+		if path not in self.values:
+			raise exceptions.DBusException(f'No value at {path}')
+		return self.values[path]
+
+class SystemBus(SessionBus):
+	pass
@@ -2,26 +2,42 @@ print('Loading mock serial')
 import logging
 log = logging.getLogger(__name__)
 
+class SerialException(IOError):
+	pass
+
 class Serial:
 
 	def __init__(self, *args, **kwargs) -> None:
 		log.info(f' Serial {args} {kwargs}')
-		self.data = []
+		self.data = bytearray()
 		self._lastWrite = []
+		self.writes = []
+		self.name = kwargs.get('port')
 		pass
 
 	def setbuffer(self, data):
 		log.info(f'buffer {data}')
-		self.data = data
+		self.data = bytearray(data)
 
-	def read(self, size):
+	def read(self, size=1):
 		log.info(f'<serial {self.data}')
-		return self.data
+		data = self.data[:size]
+		del self.data[:size]
+		return data
 
 	def write(self, data):
+		# like a real port, keep a copy as the server reuses its buffers
+		data = bytes(data)
 		self._lastWrite = data
+		self.writes.append(data)
 		log.info(f'serial> {data}')
 
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
+
 	@property
 	def lastWrite(self):
 		return self._lastWrite
@@ -3,7 +3,11 @@ import serial
 import time
 import struct
 import random
+import fcntl
 from datastore import SD230DataStore
+from meterprofiles import Profile
+from crc import computeCRC
+from stats import Histogram
 
 
 # --------------------------------------------------------------------------- #
@@ -13,6 +17,71 @@ import logging
 log = logging.getLogger(__name__)
 
 
+# request frame, unit, function, address, count, crc
+REQUEST = struct.Struct('>BBHHH')
+# response header, unit, function, byte count
+RESPONSE_HEADER = struct.Struct('>BBB')
+CRC = struct.Struct('>H')
+# largest read response, 125 registers
+MAX_RESPONSE = 5 + 250
+
+# exception codes
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_ADDRESS = 0x02
+ILLEGAL_VALUE = 0x03
+
+
+def checkRead(function: int, count: int) -> int:
+    '''
+    The exception code for a read request, 0 if it can be answered. Only read input
+    registers (4) and read holding registers (3) are served, by RTU and TCP alike.
+    '''
+    if function != 4 and function != 3:
+        return ILLEGAL_FUNCTION
+    if count < 1 or count > 125:
+        return ILLEGAL_VALUE
+    return 0
+
+
+def sliceHolding(holdingBlocks: list, address: int, count: int):
+    '''
+    The bytes of a holding register range from the blocks Profile.compileHolding built,
+    None if the range is not inside one block.
+    '''
+    for blockAddress, blockCount, block in holdingBlocks:
+        if address >= blockAddress and address + count <= blockAddress + blockCount:
+            start = (address - blockAddress)*2
+            return block[start:start + count*2]
+    return None
+
+
+# linux/serial.h, used to request low latency from USB serial adapters.
+TIOCGSERIAL = 0x541E
+TIOCSSERIAL = 0x541F
+ASYNC_LOW_LATENCY = 1 << 13
+# offset of flags in struct serial_struct, after type, line, port and irq.
+SERIAL_STRUCT_FLAGS = 16
+SERIAL_STRUCT_SIZE = 72
+
+
+def setLowLatency(port) -> bool:
+    '''
+    Ask the kernel to set ASYNC_LOW_LATENCY on the tty, which stops USB serial
+    drivers holding received bytes for up to 16ms before passing them up.
+    Returns True if the flag was set, False if the device does not support it (eg a pty).
+    '''
+    try:
+        buf = bytearray(SERIAL_STRUCT_SIZE)
+        fcntl.ioctl(port.fileno(), TIOCGSERIAL, buf)
+        flags = struct.unpack_from('=i', buf, SERIAL_STRUCT_FLAGS)[0]
+        struct.pack_into('=i', buf, SERIAL_STRUCT_FLAGS, flags | ASYNC_LOW_LATENCY)
+        fcntl.ioctl(port.fileno(), TIOCSSERIAL, buf)
+        log.info(f'Low latency set on {port.name}')
+        return True
+    except (OSError, AttributeError, ValueError) as e:
+        log.info(f'Low latency not available {e}')
+        return False
+
 
 
 class CannedSerial(object):
@@ -64,6 +133,9 @@ class CannedSerial(object):
     def write(self, value) -> None:
         log.info(f'{value.hex()}')
 
+    def flush(self) -> None:
+        pass
+
 class RandomSerial(object):
 
 
@@ -132,18 +204,41 @@ class RandomSerial(object):
     def write(self, value) -> None:
         log.info(f'{value.hex()}')
 
+    def flush(self) -> None:
+        pass
+
 class Request(object):
-    def __init__(self, frame) -> None:
-        self.unit_id = int(frame[0])
-        self.function = int(frame[1])
-        self.address, self.count = struct.unpack(">HH", frame[2:6])
-        self.frame = bytearray(frame)
+    '''
+    A decoded request frame. The server decodes every frame into the same instance,
+    so anything kept past the next frame must be a copy().
+    '''
+    def __init__(self, frame=None) -> None:
+        self.unit_id = 0
+        self.function = 0
+        self.address = 0
+        self.count = 0
+        self.crc = 0
+        if frame != None:
+            self.decode(frame, 0)
+
+    def decode(self, buffer, offset: int) -> None:
+        self.unit_id, self.function, self.address, self.count, self.crc = REQUEST.unpack_from(buffer, offset)
+
+    def copy(self) -> 'Request':
+        request = Request()
+        request.unit_id, request.function, request.address, request.count, request.crc = \
+            self.unit_id, self.function, self.address, self.count, self.crc
+        return request
+
+    @property
+    def frame(self) -> bytes:
+        return REQUEST.pack(self.unit_id, self.function, self.address, self.count, self.crc)
+
     def __str__(self) -> str:
         return f'unit:{self.unit_id} fn:{self.function} addr:{self.address} count:{self.count} Frame:{self.frame.hex()}'
-        pass
 
-    def key(self):
-        return f'{self.unit_id}:{self.function}:{self.address}:{self.count}'
+    def key(self) -> int:
+        return (self.unit_id << 40) | (self.function << 32) | (self.address << 16) | self.count
 
 
 
@@ -157,7 +252,13 @@ class ModbusRTUSerialServer(object):
 
     def __init__(self, datastore: SD230DataStore, device , 
             unit:int=0x02,
-            baudrate:int=9600) -> None:
+            baudrate:int=9600,
+            lowLatency:bool=False,
+            profile:str='sdm230',
+            analyser=None,
+            ageTracer=None,
+            echo:bool=False,
+            echoTimeout:float=0.05) -> None:
         """ Overloaded initializer for the socket server
 
         :param port: The serial port to attach to
@@ -166,63 +267,158 @@ class ModbusRTUSerialServer(object):
         :param parity: Which kind of parity to use
         :param baudrate: The baud rate to use for the serial device
         :param timeout: The timeout to use for the serial device
+        :param lowLatency: Request the kernel low latency flag on the tty
+        :param profile: The register profile served, see SD230DataStore.profiles
+        :param device: A tty path, an object with the serial api, or None for RandomSerial
+        :param analyser: A BusAnalyser to classify all traffic on the bus, None to only look for our requests
+        :param ageTracer: A DataAgeTracer to record how old the values in each reply are
+        :param echo: The RS485 adapter echoes our transmit back into the receive stream
+        :param echoTimeout: Seconds after the drain completes the echo must have started to arrive
         """
         self.unit = unit
+        self.analyser = analyser
+        self.ageTracer = ageTracer
+        self.profile = datastore.getProfile(profile)
+        self.holdingBlocks = self.profile.compileHolding({'unit': unit, 'baudrate': baudrate})
+        self.holdingReplies = {}
+        self.exceptions = {}
         self.packetCount = {}
         self.totalPacketCount = 0
-        self._buffer = b''
+        self._buffer = bytearray()
         self._bp = 0
+        # the steady state path reuses these rather than allocating per frame
+        self.request = Request()
+        self.response = bytearray(MAX_RESPONSE)
+        self.responseViews = {}
+        # 8N1 is 10 bits per character
+        self.charTime = 10.0/baudrate
+        self.drainTime = Histogram()
+        # from decoding a request for our unit to the reply leaving the UART
+        self.responseTime = Histogram()
+        # wall clock times come from the datastore, so a soak runs everything on its simulated clock
+        self.clock = datastore.clock
+        self.lastValidFrame = self.clock()
+        self.rejectCount = 0
+        # set by the health supervisor, carried out between frames by the thread reading the port
+        self.repair = None
+        # the last reply written while its echo is due, the reply buffers are not reused until
+        # the next request, which on an echoing adapter always arrives after the echo
+        self.expectEcho = echo
+        self.echoTimeout = echoTimeout
+        self.echo = None
+        # where the echo starts in the scan buffer, bytes before it arrived before the reply was written
+        self.echoAt = 0
+        self.echoDeadline = 0.0
+        self.echoCount = 0
+        self.echoMissing = 0
+        # foreign bytes where our echo should be, the master or another device talking over us
+        self.collisions = 0
+        # replies sent after the master had already started transmitting again
+        self.lateReplies = 0
+        # set by a config reload, swapped to between frames by the thread reading the port
+        self.pendingConfig = None
 
 
         # datacontext implements 
         self.datastore = datastore
-        self.__crc16_table = self.generate_crc16_table()
-
-        if device != None:
-            self.serial = serial.Serial(port=device,
-                                        timeout=1, 
-                                        bytesize=8,
-                                        stopbits=1,
-                                        baudrate=baudrate,
-                                        parity='N')
-        else:
-            self.serial = RandomSerial()
 
+        self.name = device if isinstance(device, str) else type(device).__name__
+        self.device = device
+        self.baudrate = baudrate
+        self.lowLatency = lowLatency
+        if isinstance(device, str):
+            self.serial = self.open()
+        elif device == None:
+            self.serial = RandomSerial()
+        else:
+            self.serial = device
+
+    def open(self):
+        port = serial.Serial(port=self.device,
+                                    timeout=1, 
+                                    bytesize=8,
+                                    stopbits=1,
+                                    baudrate=self.baudrate,
+                                    parity='N')
+        if self.lowLatency:
+            setLowLatency(port)
+        return port
+
+    def resetScanner(self) -> None:
+        del self._buffer[:]
+        self._bp = 0
+        self.echoAt = 0
 
-    def generate_crc16_table(self):
-        """ Generates a crc16 lookup table
-
-        .. note:: This will only be generated once
-        """
-        result = []
-        for byte in range(256):
-            crc = 0x0000
-            for _ in range(8):
-                if (byte ^ crc) & 0x0001:
-                    crc = (crc >> 1) ^ 0xa001
-                else: crc >>= 1
-                byte >>= 1
-            result.append(crc)
-        return result
-
-
-    def computeCRC(self, data):
-        """ Computes a crc16 on the passed in string. For modbus,
-        this is only used on the binary serial protocols (in this
-        case RTU).
-
-        The difference between modbus's crc16 and a normal crc16
-        is that modbus starts the crc value out at 0xffff.
-
-        :param data: The data to create a crc16 of
-        :returns: The calculated CRC
-        """
-        crc = 0xffff
-        for a in data:
-            idx = self.__crc16_table[(crc ^ a) & 0xff]
-            crc = ((crc >> 8) & 0xff) ^ idx
-        swapped = ((crc << 8) & 0xff00) | ((crc >> 8) & 0x00ff)
-        return swapped
+    def reopen(self) -> bool:
+        '''
+        Close and open the tty again, only possible when the server opened it.
+        '''
+        if not isinstance(self.device, str):
+            return False
+        try:
+            self.serial.close()
+        except (OSError, serial.SerialException) as e:
+            log.info(f'{self.name} close failed {e}')
+        self.resetScanner()
+        self.serial = self.open()
+        return True
+
+    def performRepair(self) -> None:
+        repair = self.repair
+        self.repair = None
+        start = time.perf_counter()
+        if repair == 'scanner':
+            log.warning(f'{self.name} reset scanner, {len(self._buffer)} bytes dropped')
+            self.resetScanner()
+        elif repair == 'serial':
+            try:
+                if not self.reopen():
+                    log.warning(f'{self.name} cant be reopened')
+                    return
+            except (OSError, serial.SerialException) as e:
+                log.error(f'{self.name} reopen failed {e}')
+                return
+        log.warning(f'{self.name} repair {repair} took {(time.perf_counter()-start)*1000:.1f}ms')
+
+
+    def reconfigure(self, profile: Profile, unit: int, baudrate: int, lowLatency: bool, echo: bool, ageTracer) -> None:
+        '''
+        Called from the main loop on a reload, the thread reading the port applies the settings between frames.
+        '''
+        self.pendingConfig = (profile, unit, baudrate, lowLatency, echo, ageTracer, time.perf_counter())
+
+    def applyConfig(self) -> None:
+        '''
+        Swap to the pending settings, everything derived from the unit or profile is rebuilt
+        first so no frame is served from a mix. The port is reopened only if its settings changed.
+        '''
+        profile, unit, baudrate, lowLatency, echo, ageTracer, requested = self.pendingConfig
+        self.pendingConfig = None
+        start = time.perf_counter()
+        holdingBlocks = profile.compileHolding({'unit': unit, 'baudrate': baudrate})
+        reopen = baudrate != self.baudrate or lowLatency != self.lowLatency
+        self.profile = profile
+        self.unit = unit
+        self.holdingBlocks = holdingBlocks
+        self.holdingReplies = {}
+        self.exceptions = {}
+        self.expectEcho = echo
+        self.echo = None
+        self.ageTracer = ageTracer
+        self.baudrate = baudrate
+        self.lowLatency = lowLatency
+        self.charTime = 10.0/baudrate
+        if reopen:
+            try:
+                reopen = self.reopen()
+            except (OSError, serial.SerialException) as e:
+                log.error(f'{self.name} reopen failed {e}')
+        end = time.perf_counter()
+        log.info(f'{self.name} now unit {unit} {profile.name} {baudrate} baud{" reopened" if reopen else ""}, '
+            f'swap took {(end-start)*1000:.2f}ms, {(end-requested)*1000:.0f}ms after the reload')
+
+    # crc.computeCRC, kept as a method for the frame handling code
+    computeCRC = staticmethod(computeCRC)
 
 
     def checkCRC(self, data, check):
@@ -234,14 +430,15 @@ class ModbusRTUSerialServer(object):
         """
         return self.computeCRC(data) == check
 
-    def countPackets(self, key):
+    def countPackets(self, key: int):
         self.totalPacketCount = self.totalPacketCount + 1
-        if key in self.packetCount:
-            self.packetCount[key] = self.packetCount[key] + 1
-        else:
-            self.packetCount[key] = 1
-        if self.totalPacketCount%100 == 0:
-            log.debug(f'Total:{self.totalPacketCount} {self.packetCount}')
+        self.packetCount[key] = self.packetCount.get(key, 0) + 1
+        if self.totalPacketCount%100 == 0 and log.isEnabledFor(logging.DEBUG):
+            counts = {f'{k >> 40}:{(k >> 32) & 0xff}:{(k >> 16) & 0xffff}:{k & 0xffff}': n for k, n in self.packetCount.items()}
+            log.debug(f'{self.name} Total:{self.totalPacketCount} {counts}')
+            log.debug(f'{self.name} Drain {self.drainTime}')
+            log.debug(f'{self.name} Echoes:{self.echoCount} missing:{self.echoMissing} '
+                f'collisions:{self.collisions} late:{self.lateReplies}')
 
 
     def checkPacket(self, packet):
@@ -265,24 +462,79 @@ class ModbusRTUSerialServer(object):
 
 
 
-    def sendReadResponse(self, request, response):
-        result = b''
-        for register in response:
-            result += struct.pack('>H', register)
-
-        packet = struct.pack(">BBB",
+    def write(self, packet) -> None:
+        '''
+        Write the packet and wait for it to leave the UART. On half duplex RS485
+        the line cant turn around until the drain completes, so the time is recorded.
+        '''
+        start = time.perf_counter()
+        self.serial.write(packet)
+        self.serial.flush()
+        end = time.perf_counter()
+        self.drainTime.record(end - start)
+        if self.expectEcho:
+            if self.echo != None:
+                self.echoMissing += 1
+            self.echo = packet
+            # any bytes already received, eg the master starting its next frame, come before the echo
+            self.echoAt = len(self._buffer)
+            self.echoDeadline = end + self.echoTimeout
+        if self.analyser != None:
+            self.analyser.onTransmit(len(packet), start)
+
+    def checkEcho(self) -> int:
+        '''
+        Compare the bytes received after the reply was written with it, on a 2 wire adapter
+        our own transmit comes back next. A match is dropped in one step rather than scanned
+        byte by byte, bytes that were already waiting before it are kept for scanning, anything else while the echo is due is a collision and bytes arriving only
+        after it was due mean the echo went missing, either way scanning carries on as normal.
+        Returns 1 when the echo was dropped, -1 when only part of it has arrived, else 0.
+        '''
+        echo = self.echo
+        buffer = self._buffer
+        at = self.echoAt
+        n = len(echo)
+        received = buffer[at:at+n]
+        if len(received) == n:
+            if received == echo:
+                del buffer[at:at+n]
+                self.echo = None
+                self.echoCount += 1
+                return 1
+        elif echo[:len(received)] == received:
+            if time.perf_counter() < self.echoDeadline:
+                return -1
+        self.echo = None
+        if time.perf_counter() < self.echoDeadline:
+            self.collisions += 1
+            log.info(f'{self.name} collision, expected echo {bytes(echo).hex()} got {received.hex()}')
+        else:
+            self.echoMissing += 1
+        return 0
+
+    def sendReadResponse(self, request):
+        '''
+        Pack the registers straight into the preallocated reply, after the 3 byte header.
+        The reply is written through a view of the right length, kept per length.
+        '''
+        length = 5 + request.count*2
+        packet = self.responseViews.get(length)
+        if packet == None:
+            packet = memoryview(self.response)[:length]
+            self.responseViews[length] = packet
+        response = self.response
+        RESPONSE_HEADER.pack_into(response, 0,
                              request.unit_id,
                              request.function,
-                             len(response)*2
+                             request.count*2
                              )
-        packet += result
-        packet += struct.pack(">H", self.computeCRC(packet))
-        if self.checkPacket(packet):
+        plan = self.datastore.packRegisters(self.profile, request.address, request.count, response, 3)
+        CRC.pack_into(response, length-2, self.computeCRC(response, 0, length-2))
+        if log.isEnabledFor(logging.DEBUG):
             log.debug(f'send {packet.hex()}')
-        else:
-            log.info(f'send {packet.hex()}')
-        self.checkPacket(packet)
-        self.serial.write(packet)
+        self.write(packet)
+        if self.ageTracer != None:
+            self.ageTracer.onServed(plan.paths, self.clock())
 
 
 
@@ -299,34 +551,64 @@ class ModbusRTUSerialServer(object):
     '''
 
 
-    def sendIllegalFunction(self, request):
-        packet = struct.pack(">BB",
-                             request.unit_id,
-                             request.fn | 0x80,
-                             0x01)
-        packet += struct.pack(">H", self.computeCRC(packet))
-        self.serial.write(packet)
+    def sendException(self, request, code: int) -> None:
+        '''
+        Exception replies only depend on the function and code, so are built once.
+        '''
+        key = (request.function << 8) | code
+        packet = self.exceptions.get(key)
+        if packet == None:
+            packet = bytearray(struct.pack(">BBB", self.unit, request.function | 0x80, code))
+            packet += struct.pack(">H", self.computeCRC(packet))
+            packet = bytes(packet)
+            self.exceptions[key] = packet
+        log.info(f"error {code} {request}")
+        self.write(packet)
 
-    def sendIllegalCount(self, request):
-        packet = struct.pack(">BB",
-                             request.unit_id,
-                             request.fn | 0x80,
-                             0x03)
-        packet += struct.pack(">H", self.computeCRC(packet))
-        self.serial.write(packet)
+    def sendIllegalFunction(self, request):
+        self.sendException(request, ILLEGAL_FUNCTION)
 
+    def sendIllegalAddress(self, request):
+        self.sendException(request, ILLEGAL_ADDRESS)
 
-    def decodeFrame(self, frame):
-        if len(frame) == 8:
-            request = Request(frame)
-            crc = struct.unpack('>H', frame[6:8])[0]
-            if self.checkCRC(frame[0:-2], crc):
-                # frame is valid, extract values
-                return request
-            elif request.unit_id == 2 and request.function == 4:
-                log.info(f'Rejected {request}')
-        else:
-            log.info("Frame not len 8")
+    def sendIllegalCount(self, request):
+        self.sendException(request, ILLEGAL_VALUE)
+
+    def sendHoldingResponse(self, request) -> None:
+        '''
+        Holding registers are read only configuration, replies are sliced from the
+        precomputed blocks and kept, a range outside every block is an illegal address.
+        '''
+        key = (request.address << 16) | request.count
+        packet = self.holdingReplies.get(key)
+        if packet == None:
+            registers = sliceHolding(self.holdingBlocks, request.address, request.count)
+            if registers == None:
+                self.sendIllegalAddress(request)
+                return
+            packet = bytearray(struct.pack(">BBB", self.unit, request.function, request.count*2))
+            packet += registers
+            packet += struct.pack(">H", self.computeCRC(packet))
+            packet = bytes(packet)
+            if len(self.holdingReplies) < 64:
+                self.holdingReplies[key] = packet
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'send {packet.hex()}')
+        self.write(packet)
+
+
+    def decodeFrame(self, buffer, offset: int = 0):
+        '''
+        Decode the 8 bytes at offset into self.request, None if the CRC does not match.
+        '''
+        request = self.request
+        request.decode(buffer, offset)
+        if self.computeCRC(buffer, offset, offset+6) == request.crc:
+            # frame is valid, extract values
+            return request
+        elif request.unit_id == self.unit:
+            self.rejectCount += 1
+            log.info(f'Rejected {request}')
         return None
 
     def processIncomingPacket(self, data):
@@ -335,40 +617,71 @@ class ModbusRTUSerialServer(object):
         # then test for a valid request frame
         #
         if data:
+            if self.analyser != None:
+                now = time.perf_counter()
+                self.analyser.onReceive(len(data), now)
+            debug = log.isEnabledFor(logging.DEBUG)
             self._buffer += data
             # scan upto the buffer - 8, because all requests are 8 long
             # and this a slave
-            log.debug(f'start {self._bp} {len(self._buffer)} {self._buffer.hex()}')
-            while self._bp <= len(self._buffer)-8:
-                request = self.decodeFrame(self._buffer[self._bp:self._bp+8])
+            if debug:
+                log.debug(f'start {self._bp} {len(self._buffer)} {self._buffer.hex()}')
+            while True:
+                if self.echo != None and len(self._buffer) > self.echoAt:
+                    echoed = self.checkEcho()
+                    if echoed > 0:
+                        continue
+                    elif echoed < 0:
+                        break
+                if self.analyser != None and self._bp == 0:
+                    # skip over the response to another units request, rather than scanning it
+                    length = self.analyser.matchResponse(self._buffer, 0, self.checkCRC)
+                    if length > 0:
+                        del self._buffer[:length]
+                        self.echoAt = max(self.echoAt - length, 0)
+                        continue
+                    elif length < 0:
+                        break
+                if self._bp > len(self._buffer)-8:
+                    break
+                request = self.decodeFrame(self._buffer, self._bp)
                 if request:
                     self.countPackets(request.key())
+                    if self.analyser != None:
+                        self.analyser.onRequest(request, now, request.unit_id == self.unit)
                     if request.unit_id == self.unit:
-                        if ( request.function == 4):
+                        self.lastValidFrame = self.clock()
+                        start = time.perf_counter()
+                        if len(self._buffer) > self._bp+8:
+                            # the master has started its next frame, it gave up waiting for this reply
+                            self.lateReplies += 1
+                        code = checkRead(request.function, request.count)
+                        if code != 0:
+                            self.sendException(request, code)
+                        elif ( request.function == 4):
                             # input
-                            if request.count > 125:
-                                self.sendIllegalCount(request)
-                            else:
-                                reg_count = 0
-                                registers = []
-                                while reg_count < request.count:
-                                    reg_count = reg_count + self.datastore.packValue(request.address, reg_count, registers)
+                            if debug:
                                 log.debug(f"ok {request} {self._buffer.hex()}")
-                                self.sendReadResponse(request, registers)
+                            self.sendReadResponse(request)
                         else:
-                            self.sendIllegalFunction(request)
-                            log.info(f"error {request} ")
-                    else:
+                            # holding
+                            self.sendHoldingResponse(request)
+                        self.responseTime.record(time.perf_counter() - start)
+                    elif debug:
                         # pass, ignore since not this unit
                         log.debug(f"ignore {request} {self._buffer.hex()} ")
-                    self._buffer = self._buffer[self._bp+8:]
+                    del self._buffer[:self._bp+8]
+                    self.echoAt = max(self.echoAt - (self._bp+8), 0)
                     self._bp = 0
                 else:
                     self._bp = self._bp+1
             self._bp = self._bp-1
             if self._bp < 0:
                 self._bp = 0
-            log.debug(f'end {self._bp} {len(self._buffer)} {self._buffer.hex()}')
+            if debug:
+                log.debug(f'end {self._bp} {len(self._buffer)} {self._buffer.hex()}')
+            if self.analyser != None:
+                self.analyser.checkReport(now)
 
 
 
@@ -376,23 +689,46 @@ class ModbusRTUSerialServer(object):
 
     
 
+    def pendingBytes(self) -> int:
+        '''
+        Number of received bytes not yet part of a decoded frame.
+        '''
+        return len(self._buffer) - self._bp
+
+    def readAvailable(self):
+        '''
+        Block for up to the port timeout for the first byte, then sleep until the
+        earliest point a request frame could be complete and take everything available.
+        Partial frames are kept in the scan buffer so no read waits for a byte count.
+        '''
+        waiting = self.serial.in_waiting
+        if waiting > 0:
+            return self.serial.read(waiting)
+        data = self.serial.read(1)
+        if data:
+            missing = 8 - self.pendingBytes() - len(data)
+            if missing > 0:
+                time.sleep(missing*self.charTime)
+            waiting = self.serial.in_waiting
+            if waiting > 0:
+                data = data + self.serial.read(waiting)
+        return data
+
     def handle(self, threaded: bool = False) -> None:
         #try:
         self.datastore.checkInit()
-        data = None
-        if threaded:
-            if self.serial:
-                log.debug(f'Try read {self.serial}')
-                #  Minimum valid command is 8 bytes, wait 1s for that to arrive
-                self.processIncomingPacket(self.serial.read(8))
-        else:
-            if self.serial:
-                if self.serial.in_waiting > 0:
-                    # only read what is available to avoid blocking.
-                    data = self.serial.read(self.serial.in_waiting)
-
-
-
+        if self.pendingConfig != None:
+            self.applyConfig()
+        if self.repair != None:
+            self.performRepair()
+        if self.serial:
+            if threaded:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(f'Try read {self.serial}')
+                self.processIncomingPacket(self.readAvailable())
+            elif self.serial.in_waiting > 0:
+                # only read what is available to avoid blocking.
+                self.processIncomingPacket(self.serial.read(self.serial.in_waiting))
 
 
 
@@ -0,0 +1,190 @@
+import selectors
+import socket
+import struct
+import time
+from datastore import SD230DataStore
+from modbus import checkRead, sliceHolding, ILLEGAL_ADDRESS
+from stats import Histogram
+
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+log = logging.getLogger(__name__)
+
+
+MBAP_HEADER = struct.Struct('>HHHB')
+READ_REQUEST = struct.Struct('>BHH')
+
+
+class Connection(object):
+    '''
+    Receive and send buffers for one Modbus TCP client.
+    '''
+    def __init__(self, sock, address) -> None:
+        self.sock = sock
+        self.address = address
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.writing = False
+
+
+class ModbusTCPServer(object):
+    '''
+    A non blocking Modbus TCP (MBAP) server serving input and holding registers from the same
+    datastore as the RTU server, with the same function dispatch. All connections are handled
+    by one selector loop, call handle() from a thread or a main loop.
+    '''
+
+    def __init__(self, datastore: SD230DataStore, port: int = 502,
+            host: str = '',
+            unit: int = 0x02,
+            maxConnections: int = 64,
+            profile: str = 'sdm230',
+            baudrate: int = 9600) -> None:
+        """
+        :param port: TCP port to listen on, 0 picks a free port
+        :param host: address to bind, '' for all interfaces
+        :param unit: unit id to answer, 0xff is also accepted as many TCP clients send it
+        :param maxConnections: further connections are closed on accept
+        :param profile: The register profile served, see SD230DataStore.profiles
+        :param baudrate: The rate reported in the holding registers, of the serial port sharing the profile
+        """
+        self.datastore = datastore
+        self.unit = unit
+        self.profile = datastore.getProfile(profile)
+        self.holdingBlocks = self.profile.compileHolding({'unit': unit, 'baudrate': baudrate})
+        self.maxConnections = maxConnections
+        self.connections = {}
+        self.requestCount = 0
+        self.responseTime = Histogram()
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        log.info(f'Modbus TCP listening on {host}:{self.port}')
+
+    def accept(self) -> None:
+        sock, address = self.listener.accept()
+        if len(self.connections) >= self.maxConnections:
+            log.info(f'Too many connections, reject {address}')
+            sock.close()
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(sock, address)
+        self.connections[sock.fileno()] = conn
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+        log.debug(f'Connect {address}')
+
+    def disconnect(self, conn: Connection) -> None:
+        log.debug(f'Disconnect {conn.address}')
+        self.selector.unregister(conn.sock)
+        del self.connections[conn.sock.fileno()]
+        conn.sock.close()
+
+    def buildResponse(self, tid: int, unit: int, pdu) -> bytes:
+        '''
+        Build the reply to one request PDU, including the MBAP header.
+        '''
+        function, address, count = READ_REQUEST.unpack_from(pdu, 0)
+        code = checkRead(function, count)
+        if code != 0:
+            body = struct.pack('>BB', function | 0x80, code)
+        elif function == 4:
+            body = bytearray(2 + count*2)
+            struct.pack_into('>BB', body, 0, function, count*2)
+            self.datastore.packRegisters(self.profile, address, count, body, 2)
+        else:
+            registers = sliceHolding(self.holdingBlocks, address, count)
+            if registers == None:
+                body = struct.pack('>BB', function | 0x80, ILLEGAL_ADDRESS)
+            else:
+                body = struct.pack('>BB', function, count*2) + registers
+        return MBAP_HEADER.pack(tid, 0, len(body)+1, unit) + body
+
+    def processIncoming(self, conn: Connection) -> None:
+        '''
+        Answer every complete request in the receive buffer, requests may be pipelined.
+        '''
+        while len(conn.rx) >= MBAP_HEADER.size:
+            tid, protocol, length, unit = MBAP_HEADER.unpack_from(conn.rx, 0)
+            frameLength = 6 + length
+            if protocol != 0 or length < 2 or length > 254:
+                log.info(f'Bad MBAP header from {conn.address} {conn.rx[:MBAP_HEADER.size].hex()}')
+                self.disconnect(conn)
+                return
+            if len(conn.rx) < frameLength:
+                return
+            start = time.perf_counter()
+            pdu = conn.rx[MBAP_HEADER.size:frameLength]
+            del conn.rx[:frameLength]
+            self.requestCount = self.requestCount + 1
+            if unit != self.unit and unit != 0xff:
+                log.debug(f'ignore unit {unit}')
+                continue
+            if len(pdu) != READ_REQUEST.size:
+                conn.tx += MBAP_HEADER.pack(tid, 0, 3, unit) + struct.pack('>BB', pdu[0] | 0x80, 0x03)
+            else:
+                conn.tx += self.buildResponse(tid, unit, pdu)
+            self.responseTime.record(time.perf_counter() - start)
+
+    def read(self, conn: Connection) -> None:
+        try:
+            data = conn.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.disconnect(conn)
+            return
+        if not data:
+            self.disconnect(conn)
+            return
+        conn.rx += data
+        self.processIncoming(conn)
+        if conn.sock.fileno() in self.connections and conn.tx:
+            self.write(conn)
+
+    def write(self, conn: Connection) -> None:
+        try:
+            sent = conn.sock.send(conn.tx)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.disconnect(conn)
+            return
+        del conn.tx[:sent]
+        # only watch for writable while there is a backlog
+        if conn.tx and not conn.writing:
+            self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+            conn.writing = True
+        elif not conn.tx and conn.writing:
+            self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+            conn.writing = False
+
+    def handle(self, timeout: float = 1.0) -> None:
+        '''
+        Service all ready connections, waiting up to timeout for activity.
+        '''
+        for key, events in self.selector.select(timeout):
+            conn = key.data
+            if conn is None:
+                self.accept()
+                continue
+            if events & selectors.EVENT_READ:
+                self.read(conn)
+            if events & selectors.EVENT_WRITE and conn.sock.fileno() in self.connections:
+                self.write(conn)
+
+    def close(self) -> None:
+        for conn in list(self.connections.values()):
+            self.disconnect(conn)
+        self.selector.unregister(self.listener)
+        self.listener.close()
+        self.selector.close()
+        log.debug("Modbus TCP server stopped")
@@ -0,0 +1,113 @@
+import os
+import sys
+import threading
+import time
+from stats import Histogram
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class SamplingProfiler(object):
+    '''
+    Samples the stacks of the watched threads with sys._current_frames every interval seconds,
+    counting identical stacks. When stopped the counts are written in the collapsed stack format
+    flamegraph.pl and speedscope read, one line per stack
+
+        thread;outer function;...;inner function count
+
+    Sampling holds the GIL, so a watched thread can be delayed by up to one sample, see sampleTime.
+    '''
+
+    def __init__(self, outputDir: str = '/data', interval: float = 0.01, maxDepth: int = 64) -> None:
+        """
+        :param outputDir: collapsed stacks are written here as sdm230device-<time to the millisecond>.folded, never overwritten
+        :param interval: seconds between samples
+        :param maxDepth: frames kept from the innermost
+        """
+        self.outputDir = outputDir
+        self.interval = interval
+        self.maxDepth = maxDepth
+        self.threads = {}
+        self.stacks = {}
+        self.samples = 0
+        self.sampleTime = Histogram()
+        self.running = False
+        self.thread = None
+        self.started = None
+
+    def watch(self, name: str, ident: int) -> None:
+        self.threads[ident] = name
+
+    def collapse(self, name: str, frame) -> str:
+        names = []
+        while frame != None and len(names) < self.maxDepth:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        names.append(name)
+        names.reverse()
+        return ';'.join(names)
+
+    def sample(self) -> None:
+        start = time.perf_counter()
+        frames = sys._current_frames()
+        for ident, name in self.threads.items():
+            frame = frames.get(ident)
+            if frame != None:
+                stack = self.collapse(name, frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        del frames
+        self.samples += 1
+        self.sampleTime.record(time.perf_counter() - start)
+
+    def run(self) -> None:
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self.stacks = {}
+        self.samples = 0
+        self.sampleTime.reset()
+        self.started = time.time()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+        log.info(f'Profiling {sorted(self.threads.values())} every {self.interval*1000:.0f}ms')
+
+    def stop(self) -> str:
+        '''
+        Stop sampling and write the collapsed stacks, returns the file written.
+        '''
+        if not self.running:
+            return None
+        self.running = False
+        self.thread.join()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started)) + f'.{int(self.started*1000) % 1000:03d}'
+        # never overwrite an earlier profile, profiles started in the same millisecond get a counter
+        n = 0
+        while True:
+            fileName = os.path.join(self.outputDir, f'sdm230device-{stamp}{f"-{n}" if n else ""}.folded')
+            try:
+                with open(fileName, 'x') as f:
+                    for stack, count in sorted(self.stacks.items()):
+                        f.write(f'{stack} {count}\n')
+                break
+            except FileExistsError:
+                n += 1
+            except OSError as e:
+                log.error(f'Cant write {fileName} {e}')
+                return None
+        log.info(f'Profile of {self.samples} samples written to {fileName}, sample {self.sampleTime}')
+        return fileName
+
+    def toggle(self) -> bool:
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        # keep the GLib signal handler installed
+        return True
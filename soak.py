@@ -0,0 +1,194 @@
+import csv
+import gc
+import math
+import random
+import resource
+import struct
+import time
+import dbus
+from datastore import SD230DataStore, VE_INTERFACE
+from modbus import ModbusRTUSerialServer, CannedSerial
+from stats import currentRss
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def parseDuration(text: str) -> float:
+    '''
+    Seconds from 90, 90s, 45m, 6h, 14d or 2w.
+    '''
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if text and text[-1] in units:
+        return float(text[:-1])*units[text[-1]]
+    return float(text)
+
+
+class SoakSerial(object):
+    '''
+    Stands in for the port, replies are counted and dropped.
+    '''
+    name = 'soak'
+
+    def __init__(self) -> None:
+        self.written = 0
+
+    def write(self, data) -> None:
+        self.written += len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class FakeSource(object):
+    '''
+    A grid service without DBus, passed to the datastore as its bus so values go through the same
+    blocking reads, TTL and missing path handling as on the GX. A daily PV curve with noise so values
+    change every update and the derived values and energy integration are exercised.
+    '''
+    serviceName = 'com.victronenergy.grid.soak'
+
+    def __init__(self, seed: int = 1) -> None:
+        self.random = random.Random(seed)
+        self.forward = 1000.0
+        self.reverse = 100.0
+        self.values = {}
+
+    def list_names(self) -> list:
+        return [self.serviceName]
+
+    def call_blocking(self, service: str, path: str, interface: str, method: str, signature: str, args: list):
+        if service != self.serviceName or interface != VE_INTERFACE or path not in self.values:
+            raise dbus.exceptions.DBusException(f'{service} has no {path}')
+        return self.values[path]
+
+    def update(self, now: float) -> None:
+        day = (now % 86400)/86400
+        pv = max(0.0, 4000*math.sin(math.pi*(day - 0.25)*2))
+        power = 500 + 300*self.random.random() - pv
+        voltage = 230 + 4*self.random.random()
+        if power > 0:
+            self.forward += power/3600000
+        else:
+            self.reverse -= power/3600000
+        self.values = {
+            '/Ac/Power': power,
+            '/Ac/L1/Power': power,
+            '/Ac/Voltage': voltage,
+            '/Ac/L1/Voltage': voltage,
+            '/Ac/Current': power/voltage,
+            '/Ac/L1/Current': power/voltage,
+            '/Ac/Frequency': 49.95 + 0.1*self.random.random(),
+            '/Ac/Energy/Forward': round(self.forward, 1),
+            '/Ac/Energy/Reverse': round(self.reverse, 1),
+            '/Ac/Energy/ReactiveForward': round(self.forward/10, 1),
+            '/Ac/Energy/ReactiveReverse': round(self.reverse/10, 1),
+        }
+
+
+class Soak(object):
+    '''
+    Endurance run of one server against a simulated clock. Requests follow the PV inverters
+    poll pattern, registers 0-17 between each of the other blocks, sent back to back at the bus rate,
+    each exchange advances the simulated clock by its time on the wire. The datastore and server
+    run on the simulated clock, value TTLs, ages and retries included. speed 1 paces the run in
+    real time, 0 runs as fast as the CPU allows. A CSV row is written every period simulated seconds.
+    '''
+
+    def __init__(self, duration: float, csvFile: str, period: float = 3600,
+            speed: float = 0, unit: int = 0x02, profile: str = 'sdm230', baudrate: int = 9600,
+            fakeSource: bool = True, seed: int = 1) -> None:
+        # simulated time starts now, so the clock reads like wall clock time
+        self.epoch = time.time()
+        self.simulated = 0.0
+        self.source = FakeSource(seed) if fakeSource else None
+        self.datastore = SD230DataStore(dbusConn=self.source, clock=self.clock)
+        datastore = self.datastore
+        self.duration = duration
+        self.csvFile = csvFile
+        self.period = period
+        self.speed = speed
+        self.serial = SoakSerial()
+        self.server = ModbusRTUSerialServer(datastore, self.serial, unit=unit, profile=profile, baudrate=baudrate)
+        self.random = random.Random(seed)
+        # registers 0-17 every other request, as the inverter polls them at 5Hz
+        self.frames = []
+        for frame in CannedSerial.testpattern[1:]:
+            self.frames.append(self.requestFrame(CannedSerial.testpattern[0], unit))
+            self.frames.append(self.requestFrame(frame, unit))
+        self.rows = 0
+
+    def clock(self) -> float:
+        return self.epoch + self.simulated
+
+    def requestFrame(self, pattern, unit: int) -> bytes:
+        frame = bytearray(pattern[:6])
+        frame[0] = unit
+        frame += struct.pack('>H', self.server.computeCRC(frame))
+        return bytes(frame)
+
+    def wireTime(self, frame: bytes) -> float:
+        '''
+        Request and response characters plus the 3.5 character gap after each.
+        '''
+        count = (frame[4] << 8) | frame[5]
+        return (8 + 5 + count*2 + 7)*self.server.charTime
+
+    def row(self, writer, simulated: float, started: float, lastResponse) -> None:
+        server = self.server
+        window = server.responseTime.since(lastResponse)
+        elapsed = time.perf_counter() - started
+        counts = gc.get_count()
+        collections = [generation['collections'] for generation in gc.get_stats()]
+        writer.writerow([
+            f'{simulated:.0f}', f'{elapsed:.3f}', server.totalPacketCount,
+            f'{server.totalPacketCount/elapsed if elapsed > 0 else 0:.0f}',
+            f'{window.percentile(50)*1e6:.0f}', f'{window.percentile(90)*1e6:.0f}',
+            f'{window.percentile(99)*1e6:.0f}', f'{window.max*1e6:.0f}',
+            currentRss(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            counts[0], collections[0], collections[1], collections[2], len(gc.get_objects()),
+            len(server._buffer), len(server.packetCount),
+        ])
+        self.rows += 1
+
+    def run(self) -> None:
+        log.info(f'Soak {self.duration:.0f}s simulated, rows every {self.period:.0f}s to {self.csvFile}')
+        server = self.server
+        nextRow = 0.0
+        nextUpdate = 0.0
+        lastResponse = server.responseTime.copy()
+        started = time.perf_counter()
+        with open(self.csvFile, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['simulated', 'elapsed', 'frames', 'framesPerSec', 'p50us', 'p90us', 'p99us', 'maxus',
+                'rssKb', 'maxRssKb', 'gcPending', 'gc0', 'gc1', 'gc2', 'objects', 'buffer', 'packetKeys'])
+            n = 0
+            while self.simulated < self.duration:
+                if self.simulated >= nextRow:
+                    self.row(writer, self.simulated, started, lastResponse)
+                    lastResponse = server.responseTime.copy()
+                    f.flush()
+                    nextRow += self.period
+                if self.source != None and self.simulated >= nextUpdate:
+                    self.source.update(self.clock())
+                    nextUpdate += 1.0
+                frame = self.frames[n % len(self.frames)]
+                n += 1
+                # some requests arrive split across reads, as they do from a USB adapter
+                split = self.random.randrange(16)
+                if split < 7:
+                    server.processIncomingPacket(frame[:split+1])
+                    server.processIncomingPacket(frame[split+1:])
+                else:
+                    server.processIncomingPacket(frame)
+                wire = self.wireTime(frame)
+                self.simulated += wire
+                if self.speed > 0:
+                    ahead = self.simulated/self.speed - (time.perf_counter() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            self.row(writer, self.simulated, started, lastResponse)
+        log.info(f'Soak done, {server.totalPacketCount} frames in {time.perf_counter() - started:.1f}s')
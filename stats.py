@@ -0,0 +1,100 @@
+import resource
+from array import array
+from bisect import bisect_left
+
+
+class Histogram(object):
+    '''
+    Fixed bucket histogram for timings in seconds.
+    Memory is constant regardless of how many values are recorded, so it can be
+    left running for the life of the process. Buckets grow by 2^(1/4) from 10us,
+    so percentiles are accurate to about 10%. Counts are kept in an unsigned array so recording
+    never allocates, the histograms are updated on the request path.
+    '''
+
+    bounds = [1e-5 * (2 ** (n/4.0)) for n in range(96)]
+
+    def __init__(self) -> None:
+        self.counts = array('Q', bytes(8*(len(self.bounds)+1)))
+        self.reset()
+
+    def reset(self) -> None:
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p: float) -> float:
+        '''
+        Upper bound of the bucket containing the p'th percentile, 0 if empty.
+        '''
+        if self.count == 0:
+            return 0.0
+        target = p * self.count / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n > 0:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def copy(self) -> 'Histogram':
+        other = Histogram()
+        other.counts[:] = self.counts
+        other.count = self.count
+        other.total = self.total
+        other.max = self.max
+        return other
+
+    def since(self, previous: 'Histogram') -> 'Histogram':
+        '''
+        The values recorded since previous, an earlier copy, so percentiles can be taken over a window
+        without resetting a histogram others are reading. The max is the top of the highest bucket used.
+        '''
+        window = Histogram()
+        for i, n in enumerate(self.counts):
+            window.counts[i] = n - previous.counts[i]
+            if window.counts[i] > 0:
+                window.max = self.bounds[i] if i < len(self.bounds) else self.max
+        window.count = self.count - previous.count
+        window.total = self.total - previous.total
+        return window
+
+    def mean(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.total/self.count
+
+    def summary(self) -> dict:
+        return {
+            'n': self.count,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+    def __str__(self) -> str:
+        return 'n:{n} mean:{mean:.6f} p50:{p50:.6f} p90:{p90:.6f} p99:{p99:.6f} max:{max:.6f}'.format(**self.summary())
+
+
+def currentRss() -> int:
+    '''
+    Resident set size now in kB, ru_maxrss only gives the peak.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*resource.getpagesize()//1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
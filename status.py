@@ -0,0 +1,88 @@
+import time
+from stats import currentRss
+
+
+class StatusCollector(object):
+    '''
+    Gathers counters and latency percentiles from the servers, the datastore and the health
+    supervisor as a flat map of BusItem style paths. Percentiles are over the window since the
+    previous collect(). Only reads state the serial threads already keep, so costs them nothing.
+    '''
+
+    def __init__(self, servers: list, datastore, health=None, processName: str = '', version: str = '',
+            ageTracer=None) -> None:
+        self.servers = servers
+        self.datastore = datastore
+        self.health = health
+        self.ageTracer = ageTracer
+        self.started = time.time()
+        self.fixed = {
+            '/Mgmt/ProcessName': processName,
+            '/Mgmt/ProcessVersion': version,
+            '/Mgmt/Connection': ' '.join(str(server.name) for server in servers),
+            '/ProductName': 'SDM230 emulator',
+            '/Connected': 1,
+        }
+        self.responseTimes = [server.responseTime.copy() for server in servers]
+        self.dbusCallTime = datastore.dbusCallTime.copy()
+
+    def collect(self, now: float = None) -> dict:
+        if now == None:
+            now = time.time()
+        values = dict(self.fixed)
+        values['/Uptime'] = int(now - self.started)
+        values['/Process/Rss'] = currentRss()
+        for n, server in enumerate(self.servers):
+            current = server.responseTime.copy()
+            window = current.since(self.responseTimes[n])
+            self.responseTimes[n] = current
+            prefix = f'/Port/{n}'
+            values[f'{prefix}/Name'] = str(server.name)
+            values[f'{prefix}/Unit'] = server.unit
+            values[f'{prefix}/Frames'] = server.totalPacketCount
+            values[f'{prefix}/Served'] = current.count
+            values[f'{prefix}/Rejects'] = server.rejectCount
+            values[f'{prefix}/Echoes'] = server.echoCount
+            values[f'{prefix}/EchoMissing'] = server.echoMissing
+            values[f'{prefix}/Collisions'] = server.collisions
+            values[f'{prefix}/LateReplies'] = server.lateReplies
+            values[f'{prefix}/LastFrameAge'] = int(now - server.lastValidFrame)
+            values[f'{prefix}/Latency/P50'] = round(window.percentile(50)*1000, 2)
+            values[f'{prefix}/Latency/P90'] = round(window.percentile(90)*1000, 2)
+            values[f'{prefix}/Latency/P99'] = round(window.percentile(99)*1000, 2)
+            values[f'{prefix}/Drain/P90'] = round(server.drainTime.percentile(90)*1000, 2)
+        current = self.datastore.dbusCallTime.copy()
+        window = current.since(self.dbusCallTime)
+        self.dbusCallTime = current
+        values['/Dbus/Calls'] = self.datastore.dbusCalls
+        values['/Dbus/Failures'] = self.datastore.dbusFailures
+        values['/Dbus/Latency/P50'] = round(window.percentile(50)*1000, 2)
+        values['/Dbus/Latency/P90'] = round(window.percentile(90)*1000, 2)
+        values['/Dbus/Latency/P99'] = round(window.percentile(99)*1000, 2)
+        if self.health != None:
+            values['/Health/Level'] = self.health.level
+            values['/Health/Problems'] = ', '.join(self.health.problems)
+        if self.ageTracer != None:
+            # since the process started, ages change slowly and the tail matters
+            for path, pathAge in list(self.ageTracer.paths.items()):
+                values[f'/DataAge{path}/P50'] = round(pathAge.age.percentile(50), 3)
+                values[f'/DataAge{path}/P90'] = round(pathAge.age.percentile(90), 3)
+                values[f'/DataAge{path}/CacheP90'] = round(pathAge.cacheAge.percentile(90), 3)
+        return values
+
+    @staticmethod
+    def text(path: str, value) -> str:
+        if '/Latency/' in path or '/Drain/' in path:
+            return f'{value:.2f}ms'
+        if path == '/Process/Rss':
+            return f'{value}kB'
+        if path == '/Uptime' or path.endswith('/LastFrameAge') or path.startswith('/DataAge/'):
+            return f'{value}s'
+        return str(value)
+
+    @staticmethod
+    def changes(previous: dict, values: dict) -> dict:
+        '''
+        The paths whose value differs from previous.
+        '''
+        return {path: value for path, value in values.items() if previous.get(path) != value}
@@ -1,12 +1,35 @@
 import sys
 import os
+import re
+import json
+import time
+import math
 import struct
+from datetime import datetime
+import socket
 
-from pymodbus.utilities import checkCRC
+from pymodbus.utilities import checkCRC, computeCRC
 
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'mocks'))
 from datastore import SD230DataStore
-from modbus import ModbusRTUSerialServer
+from modbus import ModbusRTUSerialServer, RandomSerial, CannedSerial
+from modbustcp import ModbusTCPServer
+from busanalyser import BusAnalyser
+from health import HealthSupervisor
+from profiler import SamplingProfiler
+import threading
+import tracemalloc
+import gc
+import csv
+from soak import Soak, parseDuration
+from status import StatusCollector
+from dataage import DataAgeTracer
+from config import ConfigReloader
+import analyse_traffic
+import capture
+import tempfile
+import shutil
+import subprocess
 
 import logging
 logging.basicConfig(format='%(asctime)s %(levelname)s %(name)-10s %(message)s',
@@ -15,6 +38,28 @@ logging.basicConfig(format='%(asctime)s %(levelname)s %(name)-10s %(message)s',
 log = logging.getLogger(__name__)
 
 
+def f32(value):
+    return struct.unpack('>f', struct.pack('>f', value))[0]
+
+
+def recordedPowerProfile():
+    '''
+    (time, power) from the 0-17 responses in the PV inverter capture.
+    '''
+    profile = []
+    register = None
+    with open(os.path.join(os.path.dirname(__file__), 'SDM230RTUCapture.log')) as f:
+        for line in f:
+            match = re.match(r"DATE=(.*?);ERR=NO;FRAME=(.*?);SLAVE", line)
+            if match != None:
+                frame = bytes.fromhex(match.group(2).replace('-', ''))
+                if len(frame) == 8:
+                    register = struct.unpack('>H', frame[2:4])[0]
+                elif register == 0 and len(frame) == 41:
+                    profile.append((datetime.fromisoformat(match.group(1)).timestamp(), struct.unpack('>f', frame[27:31])[0]))
+    return profile
+
+
 def checkResponseHeader(raw, expected):
     if not raw[0] == 0x02: 
         log.error(f'Unit wrong {raw[0]}')
@@ -52,7 +97,8 @@ def checkResponseHeader(raw, expected):
 if __name__ == "__main__":
     datastore = SD230DataStore()
     datastore.gridTracker = False
-    datastore.init()
+    datastore.useServiceTracker = True
+    datastore.checkInit()
     if not datastore.setValue('/Ac/Voltage',243): raise AssertionError('cant set value')
     if not datastore.setValue('/Ac/Current',-5.2): raise AssertionError('cant set value')
     if not datastore.setValue('/Ac/Power',1023): raise AssertionError('cant set value')
@@ -62,23 +108,29 @@ if __name__ == "__main__":
     if not datastore.setValue('/Ac/Frequency',49.2): raise AssertionError('cant set value')
     if not datastore.setValue('/Ac/Energy/Forward',1021): raise AssertionError('cant set value')
     if not datastore.setValue('/Ac/Energy/Reverse',101): raise AssertionError('cant set value')
-    if not datastore.setValue('/Ac/ReactiveEnergy/Forward',1088): raise AssertionError('cant set value')
-    if not datastore.setValue('/Ac/ReactiveEnergy/Reverse',1099): raise AssertionError('cant set value')
+    if not datastore.setValue('/Ac/Energy/ReactiveForward',1088): raise AssertionError('cant set value')
+    if not datastore.setValue('/Ac/Energy/ReactiveReverse',1099): raise AssertionError('cant set value')
     if not datastore.setValue('/Ac/Energy/Total',10990): raise AssertionError('cant set value')
-    if not datastore.setValue('/Ac/ReactiveEnergy/Total',10921): raise AssertionError('cant set value')
+    if not datastore.setValue('/Ac/Energy/ReactiveTotal',10921): raise AssertionError('cant set value')
 
     if datastore.setValue('/Ac/ReactiveEnergy/Fake',10921): raise AssertionError('set non existant value')
-    message = []
-    address = 0x0000
-    count = 18
-    offset = 0
-    while offset < count:
-        offset = offset + datastore.packValue(address, offset, message) 
+    message = datastore.readRegisters(0x0000, 18, datastore.getProfile('sdm230'))
+    log.info(f'{message.hex()}')
+    if struct.unpack_from('>f', message, 0)[0] != 243.0: raise AssertionError('voltage not packed')
+    if len(message) != 36: raise AssertionError('wrong number of registers packed')
 
+    ## a float straddling the end of a range is left as zero
+    message = datastore.readRegisters(0x0000, 7, datastore.getProfile('sdm230'))
+    if message[12:14] != bytes(2): raise AssertionError('straddling value packed')
 
-    log.info(f'{message}')
+    ## every profile loads and the three phase layout puts L2 in the second register pair
+    for name in ['sdm120', 'sdm230', 'sdm630', 'sdm630-1p']:
+        datastore.getProfile(name)
+    plan = datastore.getProfile('sdm630').plan(0x0000, 18)
+    if [(offset, path) for offset, path, encoder, derived in plan.entries][0:3] != [(0, '/Ac/L1/Voltage'), (4, '/Ac/L2/Voltage'), (8, '/Ac/L3/Voltage')]:
+        raise AssertionError(f'bad sdm630 plan {plan}')
 
-    server = ModbusRTUSerialServer(datastore)
+    server = ModbusRTUSerialServer(datastore, '/dev/ttyMOCK')
     ## registetrs 0-17
     buffer = bytearray([0x02, 0x04, 0x00, 0x00, 0x00, 0x12, 0x70, 0x34])
     server.serial.setbuffer(buffer)
@@ -95,7 +147,46 @@ if __name__ == "__main__":
     buffer = bytearray([0x02, 0x04, 0x00, 0x34, 0x00, 0xc, 0xb1, 0xf2])
     server.serial.setbuffer(buffer)
     server.handle()
-    checkResponseHeader(server.serial.lastWrite, [0,0,0,0,0,0])
+    checkResponseHeader(server.serial.lastWrite, [1023.0, 0, 1000.0, 0, 100.0, 1.02])
+
+    ## values the grid service does not publish are computed, only when an input changes
+    for path in ['/Ac/ApparentPower', '/Ac/ReactivePower', '/Ac/PowerFactor']:
+        del datastore.dbusValues[path]
+    apparent = f32(243*5.2)
+    reactive = f32(math.sqrt((243*5.2)**2 - 1023**2))
+    powerFactor = f32(1023/(243*5.2))
+    server.serial.setbuffer(buffer)
+    server.handle()
+    checkResponseHeader(server.serial.lastWrite, [1023.0, 0, apparent, 0, reactive, powerFactor])
+    derived = datastore.getProfile('sdm230').derived['/Ac/ApparentPower']
+    computed = derived.computeCount
+    server.serial.setbuffer(buffer)
+    server.handle()
+    if derived.computeCount != computed: raise AssertionError('recomputed with unchanged inputs')
+    datastore.setValue('/Ac/Voltage', 240)
+    server.serial.setbuffer(buffer)
+    server.handle()
+    checkResponseHeader(server.serial.lastWrite, [1023.0, 0, f32(240*5.2), 0, f32(math.sqrt((240*5.2)**2 - 1023**2)), f32(1023/(240*5.2))])
+    if derived.computeCount != computed+1: raise AssertionError('not recomputed after an input changed')
+    datastore.setValue('/Ac/Voltage', 243)
+
+    ## computed reactive power is the unsigned magnitude, exporting or a leading power factor cant give it a sign
+    datastore.setValue('/Ac/Power', -1023)
+    server.serial.setbuffer(buffer)
+    server.handle()
+    checkResponseHeader(server.serial.lastWrite, [-1023.0, 0, apparent, 0, reactive, -powerFactor])
+    datastore.setValue('/Ac/Power', 1023)
+    datastore.setValue('/Ac/PowerFactor', -0.81)
+    server.serial.setbuffer(buffer)
+    server.handle()
+    checkResponseHeader(server.serial.lastWrite, [1023.0, 0, apparent, 0, reactive, f32(-0.81)])
+    del datastore.dbusValues['/Ac/PowerFactor']
+    ## a reactive power the grid service publishes keeps its own sign
+    datastore.setValue('/Ac/ReactivePower', -242)
+    server.serial.setbuffer(buffer)
+    server.handle()
+    checkResponseHeader(server.serial.lastWrite, [1023.0, 0, apparent, 0, -242.0, powerFactor])
+    del datastore.dbusValues['/Ac/ReactivePower']
 
 
 
@@ -118,3 +209,484 @@ if __name__ == "__main__":
     server.serial.setbuffer(buffer)
     server.handle()
     checkResponseHeader(server.serial.lastWrite, [10990, 10921])
+
+    ## a path the grid service does not have is only asked for once per missingRetry
+    datastore.useServiceTracker = False
+    datastore.dbusConn.values = {'/Ac/Energy/Forward': 1021.0}
+    calls = []
+    callBlocking = datastore.dbusConn.call_blocking
+    def countingCall(*args):
+        calls.append(args[1])
+        return callBlocking(*args)
+    datastore.dbusConn.call_blocking = countingCall
+    for n in range(3):
+        datastore.readRegisters(0x0156, 4, datastore.getProfile('sdm230'))
+    if calls.count('/Ac/Energy/Reverse') != 1: raise AssertionError(f'missing path called {calls}')
+    datastore.useServiceTracker = True
+
+    ## a request split across reads is answered once the last byte arrives
+    server.serial._lastWrite = None
+    drained = server.drainTime.count
+    buffer = bytearray([0x02, 0x04, 0x00, 0x00, 0x00, 0x12, 0x70, 0x34])
+    server.serial.setbuffer(buffer[:5])
+    server.handle(threaded=True)
+    if server.serial.lastWrite != None: raise AssertionError('replied to a partial frame')
+    server.serial.setbuffer(buffer[5:])
+    server.handle(threaded=True)
+    checkResponseHeader(server.serial.lastWrite, [243.0, 0.0, 0.0, -5.2, 0.0, 0.0, 1023.0, 0.0, 0.0])
+    if server.drainTime.count != drained+1: raise AssertionError('drain time not recorded')
+
+    ## holding registers are served from the precomputed block
+    buffer = bytearray([0x02, 0x03, 0x00, 0x14, 0x00, 0x02])
+    buffer += struct.pack('>H', server.computeCRC(buffer))
+    server.serial.setbuffer(buffer)
+    server.handle()
+    reply = server.serial.lastWrite
+    if reply[0:3] != bytes([0x02, 0x03, 0x04]) or struct.unpack('>f', reply[3:7])[0] != 2.0: raise AssertionError(f'bad meter id {reply.hex()}')
+    if not checkCRC(reply[0:-2], (reply[-2] << 8) + reply[-1]): raise AssertionError('bad holding crc')
+    ## outside the holding blocks is an illegal address, unsupported functions an illegal function
+    for function, address, code in [(0x03, 0x2000, 0x02), (0x06, 0x0014, 0x01), (0x04, 0x0000, 0x03)]:
+        buffer = bytearray(struct.pack('>BBHH', 0x02, function, address, 0 if function == 0x04 else 1))
+        buffer += struct.pack('>H', server.computeCRC(buffer))
+        server.serial.setbuffer(buffer)
+        server.handle()
+        reply = server.serial.lastWrite
+        if reply[0:3] != bytes([0x02, function | 0x80, code]) or not checkCRC(reply[0:3], (reply[3] << 8) + reply[4]):
+            raise AssertionError(f'bad exception {reply.hex()}')
+
+    ## every frame addressed to a unit in the mixed function 3/4 traffic is answered
+    pattern = RandomSerial.testpattern * 3
+    # the 0x34 frames in the pattern have no valid CRC
+    for unit in [0x01, 0x02, 0x03, 0x04]:
+        expected = 0
+        n = 0
+        while n <= len(pattern) - 8:
+            if checkCRC(pattern[n:n+6], (pattern[n+6] << 8) + pattern[n+7]):
+                if pattern[n] == unit:
+                    expected = expected + 1
+                n = n + 8
+            else:
+                n = n + 1
+        unitServer = ModbusRTUSerialServer(datastore, '/dev/ttyMOCK', unit=unit)
+        for n in range(0, len(pattern), 13):
+            unitServer.serial.setbuffer(pattern[n:n+13])
+            unitServer.handle()
+        if expected == 0 or len(unitServer.serial.writes) != expected:
+            raise AssertionError(f'unit {unit} answered {len(unitServer.serial.writes)} of {expected}')
+
+    ## the analyser classifies other units responses and skips them rather than scanning them
+    analyser = BusAnalyser(9600, reportPeriod=0)
+    analysedServer = ModbusRTUSerialServer(datastore, '/dev/ttyMOCK', analyser=analyser)
+    other = bytearray([0x01, 0x04, 0x00, 0x00, 0x00, 0x02])
+    other += struct.pack('>H', server.computeCRC(other))
+    otherResponse = bytearray([0x01, 0x04, 0x04, 0x43, 0x74, 0x84, 0x95])
+    otherResponse += struct.pack('>H', server.computeCRC(otherResponse))
+    ours = bytearray([0x02, 0x04, 0x00, 0x00, 0x00, 0x12, 0x70, 0x34])
+    for n in range(5):
+        analysedServer.serial.setbuffer(other)
+        analysedServer.handle()
+        # the response arrives in two parts
+        analysedServer.serial.setbuffer(otherResponse[:4])
+        analysedServer.handle()
+        analysedServer.serial.setbuffer(otherResponse[4:] + ours)
+        analysedServer.handle()
+    summary = analyser.summary()
+    units = {unit['unit']: unit for unit in summary['units']}
+    if units[1]['responses'] != 5 or units[1]['missing'] != 0: raise AssertionError(f'responses not classified {units[1]}')
+    if units[2]['requests'] != {'4:0:18': 5} or units[2]['missing'] != 0: raise AssertionError(f'our requests not seen {units[2]}')
+    if len(analysedServer.serial.writes) != 5: raise AssertionError('our requests not answered')
+    if summary['rxBytes'] != 5*(8+9+8) or summary['txBytes'] != 5*41: raise AssertionError(f'bytes not counted {summary}')
+    log.info(analyser.compactSummary(summary))
+    analyser.dumpFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_output_bus.json')
+    analyser.checkReport(time.perf_counter() + 1)
+    with open(analyser.dumpFile) as f:
+        if len(json.load(f)['units']) != 2: raise AssertionError('bad json dump')
+    os.remove(analyser.dumpFile)
+
+    ## a repeated poll of an absent unit looks like the start of its response, it is scanned, not waited on
+    absent = bytearray([0x03, 0x03, 0x20, 0x00, 0x00, 0x10])
+    absent += struct.pack('>H', server.computeCRC(absent))
+    written = len(analysedServer.serial.writes)
+    analysedServer.serial.setbuffer(absent)
+    analysedServer.handle()
+    analysedServer.serial.setbuffer(absent + ours)
+    analysedServer.handle()
+    if len(analysedServer.serial.writes) != written+1: raise AssertionError('our request waited behind a repeated poll')
+    units = {unit['unit']: unit for unit in analyser.summary()['units']}
+    if units[3]['requests'] != {'3:8192:16': 2} or units[3]['missing'] != 2: raise AssertionError(f'{units[3]}')
+
+    ## the same registers over Modbus TCP, pipelined requests on one connection
+    tcpServer = ModbusTCPServer(datastore, port=0, host='127.0.0.1')
+    client = socket.create_connection(('127.0.0.1', tcpServer.port))
+    tcpServer.handle(0.1)
+    client.sendall(struct.pack('>HHHBBHH', 1, 0, 6, 2, 4, 0x0000, 18) + struct.pack('>HHHBBHH', 2, 0, 6, 2, 3, 0x0014, 2)
+        + struct.pack('>HHHBBHH', 3, 0, 6, 2, 3, 0x0100, 2) + struct.pack('>HHHBBHH', 4, 0, 6, 2, 6, 0x0000, 2))
+    reply = b''
+    while len(reply) < 45+13+9+9:
+        tcpServer.handle(0.1)
+        reply += client.recv(4096)
+    if struct.unpack('>HHHB', reply[0:7]) != (1, 0, 39, 2): raise AssertionError(f'bad MBAP header {reply.hex()}')
+    rtu = bytearray(reply[6:45])
+    rtu += struct.pack('>H', server.computeCRC(rtu))
+    checkResponseHeader(rtu, [243.0, 0.0, 0.0, -5.2, 0.0, 0.0, 1023.0, 0.0, 0.0])
+    if reply[45:58] != struct.pack('>HHHBBBf', 2, 0, 7, 2, 3, 4, 2.0): raise AssertionError(f'bad holding reply {reply[45:58].hex()}')
+    if reply[58:67] != struct.pack('>HHHBBB', 3, 0, 3, 2, 0x83, 0x02): raise AssertionError(f'bad address exception {reply[58:67].hex()}')
+    if reply[67:] != struct.pack('>HHHBBB', 4, 0, 3, 2, 0x86, 0x01): raise AssertionError(f'bad function exception {reply[67:].hex()}')
+    client.close()
+    tcpServer.close()
+
+    ## energy counters are integrated from the recorded power between coarse upstream updates
+    datastore = SD230DataStore()
+    datastore.gridTracker = False
+    datastore.useServiceTracker = True
+    profile = recordedPowerProfile()
+    if len(profile) < 100: raise AssertionError('recorded power profile too short')
+    upstream = 32.714
+    datastore.setValue('/Ac/Energy/Forward', upstream)
+    served = []
+    expected = 0.0
+    for n, (t, power) in enumerate(profile):
+        datastore.setValue('/Ac/Power', power, t)
+        if n > 0:
+            expected += (power + profile[n-1][1])*(t - profile[n-1][0])/2/3600000.0
+        served.append(datastore.getValue('/Ac/Energy/Forward'))
+    if any(b < a for a, b in zip(served, served[1:])): raise AssertionError('energy went backwards')
+    if len(set(served)) < len(profile)/2: raise AssertionError(f'energy not smoothed, {len(set(served))} distinct values')
+    if abs(served[-1] - (upstream + expected)) > 1e-6: raise AssertionError(f'integrated {served[-1]-upstream} expected {expected}')
+    if datastore.getValue('/Ac/Energy/Reverse') != None: raise AssertionError('reverse counter without upstream')
+    ## upstream catching up re-anchors
+    datastore.setValue('/Ac/Energy/Forward', upstream + 0.01)
+    if datastore.getValue('/Ac/Energy/Forward') != upstream + 0.01: raise AssertionError('not re-anchored to upstream')
+    ## upstream behind the integration holds the value rather than going backwards
+    ahead = datastore.getValue('/Ac/Energy/Forward')
+    t = profile[-1][0]
+    for n in range(10):
+        t = t + 0.2
+        datastore.setValue('/Ac/Power', 3600.0, t)
+    ahead = datastore.getValue('/Ac/Energy/Forward')
+    datastore.setValue('/Ac/Energy/Forward', upstream + 0.0101)
+    if datastore.getValue('/Ac/Energy/Forward') != ahead: raise AssertionError('energy went backwards on re-anchor')
+    ## export only counts towards reverse
+    datastore.setValue('/Ac/Energy/Reverse', 5.0)
+    datastore.getValue('/Ac/Energy/Reverse')
+    datastore.setValue('/Ac/Power', -3600.0, t + 1.0)
+    datastore.setValue('/Ac/Power', -3600.0, t + 2.0)
+    if abs(datastore.getValue('/Ac/Energy/Reverse') - 5.001) > 1e-9: raise AssertionError('reverse not integrated')
+
+    ## the capture analyser pairs by frame structure, missing and corrupt responses are counted against the request
+    def captureLine(t, frame):
+        frame = frame + struct.pack('>H', computeCRC(frame))
+        return f"DATE=2022-05-17T19:42:{t:06.3f};ERR=NO;FRAME={'-'.join(f'{b:02x}' for b in frame)};SLAVE=2\n"
+    request = struct.pack('>BBHH', 2, 4, 0x46, 2)
+    response = struct.pack('>BBBf', 2, 4, 4, 50.0)
+    corrupt = captureLine(3.05, response)[:-12] + 'ff-ff;SLAVE=2\n'
+    lines = ['not a capture\n', captureLine(0.0, request), captureLine(0.05, response),
+        captureLine(1.0, request), captureLine(2.0, request), captureLine(2.04, response),
+        captureLine(3.0, request), corrupt, captureLine(3.06, response), captureLine(9.0, request)]
+    traffic = analyse_traffic.TrafficStats()
+    end = datetime.fromisoformat('2022-05-17T19:42:05').timestamp()
+    for event in analyse_traffic.pairFrames(analyse_traffic.window(analyse_traffic.parseCaptures(lines), None, end)):
+        traffic.add(event)
+    keyStats = traffic.keys[request[0:6]]
+    if keyStats.requests != 4 or keyStats.responses != 3: raise AssertionError(f'{keyStats.requests} requests {keyStats.responses} responses')
+    if keyStats.missing != 1 or keyStats.crcErrors != 1: raise AssertionError(f'missing {keyStats.missing} crc {keyStats.crcErrors}')
+    if abs(keyStats.period.percentile(50) - 1.0) > 0.1: raise AssertionError(f'period {keyStats.period}')
+    if keyStats.latency.percentile(99) > 0.07 or keyStats.latency.count != 3: raise AssertionError(f'latency {keyStats.latency}')
+    if keyStats.registers[0x46].max != 50.0: raise AssertionError('float not decoded')
+
+    ## the capture tools run offline, with neither the mocks nor dbus and pyserial
+    offline = subprocess.run([sys.executable, '-c', 'import sys; sys.modules["dbus"] = sys.modules["serial"] = None; '
+        'import analyse_traffic, bench_capture; print(analyse_traffic.crcValid(bytes.fromhex("020400000012" "7034")))'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env={'PATH': os.environ.get('PATH', '')}, capture_output=True, text=True)
+    if offline.stdout.strip() != 'True': raise AssertionError(f'analyse_traffic needs more than the standard library {offline.stderr}')
+
+    ## a binary capture holds the same frames and seeks to a window through the index
+    with tempfile.TemporaryDirectory() as tmp:
+        binary = os.path.join(tmp, 'capture.cap')
+        sample = os.path.join(os.path.dirname(__file__), 'SDM230RTUCapture.log')
+        frames = list(analyse_traffic.parseCaptures(analyse_traffic.readLines([sample])))
+        if analyse_traffic.convert([sample], binary) != len(frames): raise AssertionError('frames not all converted')
+        reader = capture.CaptureReader(binary)
+        if list(reader.frames()) != frames: raise AssertionError('binary capture differs from text')
+        start = frames[500][0]
+        end = frames[600][0]
+        windowed = list(reader.frames(start, end))
+        if windowed != list(analyse_traffic.window(frames, start, end)) or len(windowed) != 100: raise AssertionError('window differs')
+        if reader.seek(start) == capture.HEADER.size: raise AssertionError('window did not use the index')
+        requests = sum(1 for us, direction, flags, frame in reader.records() if direction == capture.DIRECTION_REQUEST)
+        polled = sum(k.requests for k in analyse_traffic.analyse([binary]).keys.values())
+        if requests != polled: raise AssertionError(f'{requests} request frames, {polled} requests analysed')
+        reader.close()
+        ## several captures are merged by time, the writer refuses frames that go backwards
+        with open(sample) as f:
+            lines = [line for line in f if line.startswith('DATE=')]
+        halves = [os.path.join(tmp, 'even.log'), os.path.join(tmp, 'odd.log')]
+        for n, half in enumerate(halves):
+            with open(half, 'w') as f:
+                f.writelines(lines[n::2])
+        merged = os.path.join(tmp, 'merged.cap')
+        analyse_traffic.convert(halves, merged)
+        reader = capture.CaptureReader(merged)
+        times = [us for us, direction, flags, frame in reader.records()]
+        reader.close()
+        if times != sorted(times) or len(times) != len(frames): raise AssertionError('captures not merged in time order')
+        with capture.CaptureWriter(os.path.join(tmp, 'backwards.cap')) as writer:
+            writer.add(2.0, b'\x02', capture.DIRECTION_REQUEST)
+            try:
+                writer.add(1.0, b'\x02', capture.DIRECTION_REQUEST)
+                raise AssertionError('frame going backwards accepted')
+            except ValueError:
+                pass
+
+    ## slow replies reset the scanner, reopen the port, then exit, and recover
+    healthStore = SD230DataStore()
+    healthServer = ModbusRTUSerialServer(healthStore, '/dev/ttyMOCK')
+    supervisor = HealthSupervisor([healthServer], healthStore, minSamples=2)
+    exits = []
+    supervisor.exit = lambda: exits.append(supervisor.level)
+    def slowChecks(n):
+        for check in range(n):
+            for sample in range(3):
+                healthServer.responseTime.record(0.5)
+            supervisor.check()
+            healthServer.handle(threaded=True)
+    healthServer._buffer += b'\x01\x02'
+    healthStore.missingPaths['/Ac/Power'] = time.time() + 100
+    slowChecks(1)
+    if supervisor.level != HealthSupervisor.SCANNER or len(healthServer._buffer) != 0: raise AssertionError(f'scanner not reset {supervisor.level}')
+    oldSerial = healthServer.serial
+    slowChecks(1)
+    if supervisor.level != HealthSupervisor.SERIAL or healthServer.serial is oldSerial: raise AssertionError('serial not reopened')
+    if not healthStore.missingPaths: raise AssertionError('slow replies reconnected dbus')
+    slowChecks(1)
+    if exits != [HealthSupervisor.EXIT]: raise AssertionError(f'no exit after repairs {exits}')
+    supervisor.check()
+    if supervisor.level != 0 or supervisor.ladders: raise AssertionError('did not recover')
+    ## failing DBus calls reconnect first, on the port thread not the main loop
+    healthStore.dbusCalls += 10
+    healthStore.dbusFailures += 9
+    oldBuffer = healthServer._buffer = bytearray(b'\x01\x02')
+    supervisor.check()
+    if 'dbus failures 9/10' not in supervisor.problems or supervisor.level != HealthSupervisor.DBUS: raise AssertionError(f'{supervisor.problems}')
+    if not healthStore.reconnectPending or not healthStore.missingPaths: raise AssertionError('reconnect ran on the main loop')
+    healthServer.handle(threaded=True)
+    if healthStore.reconnectPending or healthStore.missingPaths: raise AssertionError('port thread did not reconnect')
+    if len(healthServer._buffer) != 2: raise AssertionError('dbus problem reset the scanner')
+    healthStore.dbusCalls += 10
+    healthStore.dbusFailures += 9
+    supervisor.check()
+    if exits != [HealthSupervisor.EXIT, HealthSupervisor.EXIT]: raise AssertionError(f'no exit after reconnect {exits}')
+    supervisor.check()
+    ## a quiet line is reopened once and then only reported, never escalated or exited
+    healthServer.lastValidFrame = time.time() - 1000
+    supervisor.check()
+    healthServer.handle(threaded=True)
+    oldSerial = healthServer.serial
+    escalations = supervisor.escalations
+    for check in range(6):
+        supervisor.check()
+        healthServer.handle(threaded=True)
+    if supervisor.level != HealthSupervisor.SERIAL or len(exits) != 2: raise AssertionError(f'quiet line escalated to {supervisor.level}')
+    if healthServer.serial is not oldSerial or supervisor.escalations != escalations: raise AssertionError('quiet line repaired again')
+    if not any('no valid frame' in problem for problem in supervisor.problems): raise AssertionError(f'{supervisor.problems}')
+
+    ## the profiler writes collapsed stacks of the watched threads
+    def busyPort(stop):
+        while not stop.is_set():
+            sum(range(1000))
+    with tempfile.TemporaryDirectory() as tmp:
+        stop = threading.Event()
+        busy = threading.Thread(target=busyPort, args=(stop,), name='busy')
+        busy.start()
+        profiler = SamplingProfiler(tmp, interval=0.001)
+        profiler.watch('busy', busy.ident)
+        profiler.toggle()
+        time.sleep(0.1)
+        profiler.toggle()
+        stop.set()
+        busy.join()
+        folded = os.listdir(tmp)
+        if len(folded) != 1 or not folded[0].endswith('.folded'): raise AssertionError(f'{folded}')
+        with open(os.path.join(tmp, folded[0])) as f:
+            lines = f.read().splitlines()
+        if not lines or not all(line.startswith('busy;') for line in lines): raise AssertionError(f'{lines}')
+        if not any('test.py:busyPort' in line for line in lines): raise AssertionError('busy function not sampled')
+        if sum(int(line.rsplit(' ', 1)[1]) for line in lines) != profiler.samples: raise AssertionError('counts dont add up')
+        ## a second profile started in the same millisecond gets its own file
+        started = profiler.started
+        profiler.toggle()
+        profiler.toggle()
+        profiler.started = started
+        profiler.running = True
+        second = profiler.stop()
+        if second == None or len(os.listdir(tmp)) != 3 or not second.endswith('-1.folded'): raise AssertionError(f'{os.listdir(tmp)}')
+
+    ## serving makes no net allocations once warmed up, from the tracker cache and through blocking fetches
+    class SinkSerial(object):
+        name = 'sink'
+        def write(self, data):
+            pass
+        def flush(self):
+            pass
+    holding = bytearray(struct.pack('>BBHH', 2, 3, 0, 2))
+    holding += struct.pack('>H', ModbusRTUSerialServer.computeCRC(holding))
+    steadyFrames = [bytes(frame) for frame in CannedSerial.testpattern] + [bytes(holding)]
+    def retainedServing(steadyStore):
+        steadyServer = ModbusRTUSerialServer(steadyStore, SinkSerial())
+        def serveFrames(n):
+            for i in range(n):
+                steadyServer.processIncomingPacket(steadyFrames[i % len(steadyFrames)])
+        def allocatedServing(n):
+            gc.collect()
+            before = tracemalloc.get_traced_memory()[0]
+            serveFrames(n)
+            gc.collect()
+            return tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.start()
+        # until every counter has passed the small int cache and the interpreters frame free list has settled
+        serveFrames(10000)
+        # Each frame does make short lived objects, the perf_counter floats, counters past the small int
+        # cache, the stored clock and on the blocking path the reply value, all freed again by the next
+        # frame. Freed floats and ints stay on the interpreters free lists, up to 100 each, so a run can
+        # end holding a few more or less, under 1kB whatever the run length. Comparing a long and a short
+        # run leaves only memory kept per frame, one object kept per frame would be 240kB.
+        retained = allocatedServing(20000) - allocatedServing(10000)
+        tracemalloc.stop()
+        if steadyServer.totalPacketCount != 40000 or steadyServer.responseTime.count != 40000: raise AssertionError('frames not all served')
+        return retained, steadyServer
+    steadyStore = SD230DataStore()
+    steadyStore.useServiceTracker = True
+    for path in steadyStore.paths:
+        steadyStore.setValue(path, 230.5)
+    retained, steadyServer = retainedServing(steadyStore)
+    if abs(retained) > 1024: raise AssertionError(f'{retained} bytes kept serving 10000 frames from the tracker cache')
+    # every read a blocking call, the mock stands in for dbus-python, whose reply objects are freed once read
+    blockingStore = SD230DataStore()
+    blockingStore.valueTTL = 0
+    blockingStore.dbusConn.values = {path: 230.5 for path in blockingStore.paths}
+    retained, blockingServer = retainedServing(blockingStore)
+    if abs(retained) > 1024 or blockingStore.dbusCalls < 40000: raise AssertionError(f'{retained} bytes kept serving 10000 frames through blocking calls')
+
+    ## a short soak writes a row per period and the scanner keeps up with split frames
+    if parseDuration('2w') != 14*86400 or parseDuration('90') != 90: raise AssertionError('duration parse')
+    with tempfile.TemporaryDirectory() as tmp:
+        soakCsv = os.path.join(tmp, 'soak.csv')
+        soak = Soak(600, soakCsv, period=60)
+        soak.run()
+        with open(soakCsv) as f:
+            rows = list(csv.DictReader(f))
+        if len(rows) != 11 or soak.rows != 11: raise AssertionError(f'{len(rows)} soak rows')
+        last = rows[-1]
+        if int(last['frames']) != soak.server.responseTime.count or int(last['frames']) < 10000: raise AssertionError(f'{last}')
+        if last['buffer'] != '0' or last['packetKeys'] != '6': raise AssertionError(f'{last}')
+        if soak.serial.written == 0 or soak.datastore.getValue('/Ac/Power') == None: raise AssertionError('nothing served')
+        # the datastore and server ran on the simulated clock, reading through the fake grid service
+        if soak.datastore.dbusCalls < 1000 or soak.datastore.valueFetched['/Ac/Power'] < soak.epoch + 599:
+            raise AssertionError(f'{soak.datastore.dbusCalls} calls, fetched at {soak.datastore.valueFetched["/Ac/Power"] - soak.epoch}')
+        if soak.server.lastValidFrame < soak.epoch + 599 or '/Ac/ApparentPower' not in soak.datastore.missingPaths:
+            raise AssertionError('not on the simulated clock')
+
+    ## the status paths carry the counters and only changes are published
+    collector = StatusCollector([steadyServer], steadyStore, supervisor, 'test', '1.0')
+    first = collector.collect()
+    if first['/Port/0/Served'] != 40000 or first['/Port/0/Frames'] != 40000 or first['/Mgmt/ProcessName'] != 'test':
+        raise AssertionError(f'{first}')
+    # percentiles are over the window since the collector started
+    if first['/Health/Level'] != supervisor.level or first['/Port/0/Latency/P99'] != 0: raise AssertionError(f'{first}')
+    for frame in steadyFrames:
+        steadyServer.processIncomingPacket(frame)
+    steadyServer.processIncomingPacket(steadyFrames[0][:-1] + b'\x00')
+    second = collector.collect()
+    changes = StatusCollector.changes(first, second)
+    if changes.get('/Port/0/Served') != 40007 or changes.get('/Port/0/Rejects') != 1: raise AssertionError(f'{changes}')
+    if '/Mgmt/ProcessName' in changes or '/Port/0/Unit' in changes: raise AssertionError(f'unchanged paths {changes}')
+    if second['/Port/0/Latency/P99'] <= 0: raise AssertionError('no latency over the window')
+    if StatusCollector.text('/Port/0/Latency/P50', 0.5) != '0.50ms': raise AssertionError('text')
+
+    ## served values carry the time since they last changed upstream, an unchanged update is not a change
+    ageStore = SD230DataStore()
+    ageStore.useServiceTracker = True
+    changed = time.time() - 2
+    for path in ageStore.paths:
+        ageStore.setValue(path, 230.5, changed)
+    ageStore.setValue('/Ac/Power', 230.5)
+    if ageStore.pathsSeen['/Ac/Power'] != changed: raise AssertionError('unchanged value reset the age')
+    tracer = DataAgeTracer(ageStore)
+    ageServer = ModbusRTUSerialServer(ageStore, SinkSerial(), ageTracer=tracer)
+    ageServer.processIncomingPacket(bytes(CannedSerial.testpattern[0]))
+    power = tracer.paths['/Ac/Power'].age
+    if power.count != 1 or not 1.9 < power.percentile(50) < 2.5: raise AssertionError(f'age {power.summary()}')
+    # the frequency register is only in a later block
+    if '/Ac/Frequency' in tracer.paths: raise AssertionError(f'{list(tracer.paths)}')
+    ages = StatusCollector([ageServer], ageStore, ageTracer=tracer).collect()
+    if not 1.9 < ages['/DataAge/Ac/Power/P50'] < 2.5: raise AssertionError(f'{ages}')
+
+    ## an echoed reply is dropped before scanning, foreign bytes while it is due are a collision
+    echoServer = ModbusRTUSerialServer(SD230DataStore(), 'echo', echo=True)
+    echoRequest = bytes(CannedSerial.testpattern[0])
+    echoServer.processIncomingPacket(echoRequest)
+    echoServer.processIncomingPacket(echoServer.serial.lastWrite[:5])
+    if echoServer.echo == None: raise AssertionError('partial echo not held')
+    echoServer.processIncomingPacket(echoServer.serial.lastWrite[5:] + echoRequest)
+    if echoServer.echoCount != 1 or echoServer.responseTime.count != 2 or echoServer.pendingBytes() != 0:
+        raise AssertionError(f'echo {echoServer.echoCount} replies {echoServer.responseTime.count}')
+    echoServer.processIncomingPacket(b'\x55' + echoServer.serial.lastWrite[1:])
+    if echoServer.collisions != 1 or echoServer.echo != None: raise AssertionError(f'collisions {echoServer.collisions}')
+    echoServer.echoTimeout = 0
+    echoServer.processIncomingPacket(echoRequest)
+    echoServer.processIncomingPacket(echoRequest)
+    if echoServer.echoMissing != 1 or echoServer.responseTime.count != 4: raise AssertionError(f'missing {echoServer.echoMissing}')
+    ## on a late reply the echo follows the start of the masters next frame, it is not a collision
+    lateServer = ModbusRTUSerialServer(SD230DataStore(), 'late', echo=True)
+    lateServer.processIncomingPacket(echoRequest + echoRequest[:4])
+    if lateServer.lateReplies != 1 or lateServer.echoAt != 4: raise AssertionError(f'late {lateServer.lateReplies} at {lateServer.echoAt}')
+    lateServer.processIncomingPacket(lateServer.serial.lastWrite[:5])
+    lateServer.processIncomingPacket(lateServer.serial.lastWrite[5:] + echoRequest[4:])
+    if lateServer.echoCount != 1 or lateServer.collisions != 0 or lateServer.responseTime.count != 2 or lateServer.pendingBytes() != 0:
+        raise AssertionError(f'echo {lateServer.echoCount} collisions {lateServer.collisions} replies {lateServer.responseTime.count}')
+
+    ## a reload swaps unit, profile and rate between frames, keeps the value cache and rejects a bad file whole
+    with tempfile.TemporaryDirectory() as tmp:
+        reloadStore = SD230DataStore()
+        reloadStore.useServiceTracker = True
+        reloadStore.gridTracker = False
+        reloadStore.setValue('/Ac/Voltage', 241.5)
+        reloadServer = ModbusRTUSerialServer(reloadStore, 'reload')
+        profileDir = os.path.join(tmp, 'profiles')
+        shutil.copytree(reloadStore.profileDir, profileDir)
+        configFile = os.path.join(tmp, 'config.json')
+        with open(configFile, 'w') as f:
+            json.dump({'bind': ['reload:0x07:sdm120:19200'], 'profileDir': profileDir, 'valueTTL': 5,
+                'traceAge': True, 'logLevels': {'modbus': 'WARNING'}}, f)
+        reloader = ConfigReloader(configFile, [reloadServer], reloadStore)
+        reloader.reload()
+        if reloadServer.unit != 2 or reloadServer.pendingConfig == None: raise AssertionError('swapped outside the port thread')
+        reloadServer.handle()
+        if reloadServer.unit != 7 or reloadServer.profile.name != 'sdm120' or reloadServer.baudrate != 19200:
+            raise AssertionError(f'not swapped {reloadServer.unit} {reloadServer.profile.name}')
+        if reloadStore.valueTTL != 5 or reloadStore.getProfile('sdm120') is not reloadServer.profile: raise AssertionError('datastore not reloaded')
+        if reloadServer.ageTracer == None or logging.getLogger('modbus').level != logging.WARNING: raise AssertionError('switches not applied')
+        logging.getLogger('modbus').setLevel(logging.NOTSET)
+        reloadRequest = bytearray(CannedSerial.testpattern[0][:6])
+        reloadRequest[0] = 7
+        reloadRequest += struct.pack('>H', reloadServer.computeCRC(reloadRequest))
+        reloadServer.processIncomingPacket(bytes(reloadRequest))
+        reply = reloadServer.serial.lastWrite
+        if reply[0] != 7 or struct.unpack_from('>f', reply, 3)[0] != 241.5: raise AssertionError(f'reply {reply.hex()}')
+        with open(configFile, 'w') as f:
+            json.dump({'bind': ['reload:0x08:nosuchmeter'], 'valueTTL': 1}, f)
+        reloader.reload()
+        if reloadServer.pendingConfig != None or reloadStore.valueTTL != 5: raise AssertionError('bad config applied')
+        # a malformed profile raises TypeError, the reload still fails cleanly
+        with open(os.path.join(profileDir, 'broken.json'), 'w') as f:
+            json.dump({'registers': [5]}, f)
+        with open(configFile, 'w') as f:
+            json.dump({'valueTTL': 1}, f)
+        if reloader.reload() != True: raise AssertionError('signal source dropped')
+        if reloadServer.pendingConfig != None or reloadStore.valueTTL != 5: raise AssertionError('malformed profile applied')
+        os.remove(os.path.join(profileDir, 'broken.json'))
+        with open(configFile, 'w') as f:
+            json.dump({'echo': True}, f)
+        reloader.reload()
+        reloadServer.handle()
+        if not reloadServer.expectEcho or reloadServer.unit != 7 or reloader.reloads != 2: raise AssertionError('switch only reload')
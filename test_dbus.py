@@ -0,0 +1,134 @@
+import sys
+import os
+import time
+import struct
+import subprocess
+import threading
+
+# needs the real dbus-python and a dbus-daemon, so the mocks are not used
+try:
+    import dbus
+    import dbus.service
+    import dbus.mainloop.glib
+    from gi.repository import GLib
+except ImportError as e:
+    print(f'Skip, {e}')
+    sys.exit(0)
+from datastore import SD230DataStore, VE_INTERFACE
+from modbus import ModbusRTUSerialServer, CannedSerial
+from status import StatusCollector
+from dbusservice import StatusService, BusItem
+
+import logging
+logging.basicConfig(format='%(asctime)s %(levelname)s %(name)-10s %(message)s',
+                        level=logging.INFO)
+
+log = logging.getLogger(__name__)
+
+
+class SinkSerial(object):
+    name = 'sink'
+    def write(self, data):
+        pass
+    def flush(self):
+        pass
+    def close(self):
+        pass
+
+
+def startBus():
+    '''
+    A private session bus, so the test never touches the desktop or GX bus.
+    '''
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = daemon.stdout.readline().strip()
+    return daemon
+
+
+def runInLoop(fn):
+    '''
+    Run fn on the main loop thread and wait for it.
+    '''
+    done = threading.Event()
+    def call():
+        fn()
+        done.set()
+        return False
+    GLib.idle_add(call)
+    if not done.wait(5): raise AssertionError('main loop did not run')
+
+
+def test_status_service():
+    '''
+    The status service answers GetValue per path and on the root, and a publish sends
+    one ItemsChanged holding only the changed paths.
+    '''
+    daemon = startBus()
+    dbus.mainloop.glib.threads_init()
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    mainloop = GLib.MainLoop()
+    loop = threading.Thread(target=mainloop.run, daemon=True)
+    try:
+        gridBus = dbus.SessionBus(private=True)
+        grid = [BusItem(gridBus, path, value, str(value)) for path, value in
+            (('/Ac/Power', 1023.0), ('/Ac/Voltage', 243.0), ('/Ac/Current', 4.2))]
+        gridName = dbus.service.BusName('com.victronenergy.grid.test', gridBus)
+        loop.start()
+
+        datastore = SD230DataStore()
+        server = ModbusRTUSerialServer(datastore, SinkSerial())
+        for frame in CannedSerial.testpattern:
+            server.processIncomingPacket(bytes(frame))
+        if datastore.dbusCalls == 0: raise AssertionError('grid service not called')
+        service = StatusService(datastore.dbusConn, StatusCollector([server], datastore, processName='test'))
+
+        changed = []
+        client = dbus.SessionBus(private=True)
+        client.add_signal_receiver(lambda changes: changed.append(changes), signal_name='ItemsChanged',
+            dbus_interface=VE_INTERFACE, bus_name=service.serviceName, path='/')
+        served = client.call_blocking(service.serviceName, '/Port/0/Served', VE_INTERFACE, 'GetValue', '', [])
+        if served != len(CannedSerial.testpattern): raise AssertionError(f'served {served}')
+        everything = client.call_blocking(service.serviceName, '/', VE_INTERFACE, 'GetValue', '', [])
+        if everything['Mgmt/ProcessName'] != 'test' or 'Dbus/Latency/P90' not in everything: raise AssertionError(f'{everything}')
+        text = client.call_blocking(service.serviceName, '/Port/0/Latency/P99', VE_INTERFACE, 'GetText', '', [])
+        if not text.endswith('ms'): raise AssertionError(f'text {text}')
+
+        for frame in CannedSerial.testpattern:
+            server.processIncomingPacket(bytes(frame))
+        runInLoop(service.publish)
+        end = time.time() + 5
+        while not changed and time.time() < end:
+            time.sleep(0.01)
+        if len(changed) != 1 or service.signals != 1: raise AssertionError(f'{len(changed)} signals')
+        if changed[0]['/Port/0/Served']['Value'] != 2*len(CannedSerial.testpattern): raise AssertionError(f'{changed[0]}')
+        if '/Mgmt/ProcessName' in changed[0]: raise AssertionError('unchanged path sent')
+        served = client.call_blocking(service.serviceName, '/Port/0/Served', VE_INTERFACE, 'GetValue', '', [])
+        if served != 2*len(CannedSerial.testpattern): raise AssertionError(f'served {served} after publish')
+
+        # a name the bus refuses is raised to the caller and leaves no paths exported
+        claim = dbus.service.BusName
+        def refused(name, bus):
+            raise dbus.exceptions.DBusException('org.freedesktop.DBus.Error.AccessDenied')
+        refusedBus = dbus.SessionBus(private=True)
+        dbus.service.BusName = refused
+        try:
+            StatusService(refusedBus, StatusCollector([server], datastore, processName='test'), 'com.victronenergy.refused')
+            raise AssertionError('refused name not raised')
+        except dbus.exceptions.DBusException:
+            pass
+        finally:
+            dbus.service.BusName = claim
+        try:
+            client.call_blocking(refusedBus.get_unique_name(), '/Port/0/Served', VE_INTERFACE, 'GetValue', '', [])
+            raise AssertionError('paths left exported')
+        except dbus.exceptions.DBusException:
+            pass
+    finally:
+        mainloop.quit()
+        daemon.terminate()
+        daemon.wait()
+
+
+if __name__ == "__main__":
+    test_status_service()
@@ -0,0 +1,145 @@
+import sys
+import os
+import time
+import threading
+import tty
+
+# the real pyserial is needed to drive a pty, import it before the mocks path is added
+import serial
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'mocks'))
+from datastore import SD230DataStore
+from modbus import ModbusRTUSerialServer, setLowLatency
+
+import logging
+logging.basicConfig(format='%(asctime)s %(levelname)s %(name)-10s %(message)s',
+                        level=logging.INFO)
+
+log = logging.getLogger(__name__)
+
+REQUEST = bytes([0x02, 0x04, 0x00, 0x00, 0x00, 0x12, 0x70, 0x34])
+
+
+def createServer(echo=False):
+    master, slave = os.openpty()
+    # raw, so replies are not mangled by the line discipline on the way back
+    tty.setraw(master)
+    tty.setraw(slave)
+    datastore = SD230DataStore()
+    datastore.gridTracker = False
+    datastore.useServiceTracker = True
+    datastore.setValue('/Ac/Voltage', 243)
+    server = ModbusRTUSerialServer(datastore, os.ttyname(slave), baudrate=9600, echo=echo)
+    return master, slave, server
+
+
+def readReply(master, size, timeout=2.0):
+    reply = b''
+    end = time.time() + timeout
+    while len(reply) < size and time.time() < end:
+        reply += os.read(master, size - len(reply))
+    return reply
+
+
+def test_split_frame():
+    '''
+    A request arriving in two parts is answered as soon as it is complete,
+    not after the 1s port timeout.
+    '''
+    master, slave, server = createServer()
+    try:
+        def writer():
+            os.write(master, REQUEST[:3])
+            time.sleep(0.05)
+            os.write(master, REQUEST[3:])
+        t = threading.Thread(target=writer)
+        t.start()
+        start = time.time()
+        while server.drainTime.count == 0 and time.time() - start < 1.0:
+            server.handle(threaded=True)
+        elapsed = time.time() - start
+        t.join()
+        reply = readReply(master, 5+36)
+        if len(reply) != 41: raise AssertionError(f'reply length {len(reply)}')
+        if reply[0:3] != bytes([0x02, 0x04, 0x24]): raise AssertionError(f'bad reply {reply.hex()}')
+        if elapsed > 0.5: raise AssertionError(f'reply took {elapsed}s')
+        if server.drainTime.count != 1: raise AssertionError('drain time not recorded')
+        log.info(f'Split frame answered in {elapsed}s, drain {server.drainTime}')
+    finally:
+        server.close()
+        os.close(master)
+        os.close(slave)
+
+
+def test_low_latency_on_pty():
+    '''
+    A pty has no serial_struct, setting low latency must fail cleanly.
+    '''
+    master, slave, server = createServer()
+    try:
+        if setLowLatency(server.serial): raise AssertionError('pty accepted low latency')
+    finally:
+        server.close()
+        os.close(master)
+        os.close(slave)
+
+
+def serveUntil(server, done, timeout=2.0):
+    end = time.time() + timeout
+    while not done() and time.time() < end:
+        server.handle(threaded=True)
+
+
+def test_echo_discarded():
+    '''
+    A 2 wire adapter echoes each reply back into the receive stream. The echo is dropped
+    without being scanned, the next request is answered and a corrupted echo is a collision.
+    '''
+    master, slave, server = createServer(echo=True)
+    try:
+        def bus():
+            # the master side, every reply comes back as the adapter echoes it
+            os.write(master, REQUEST)
+            reply = readReply(master, 41)
+            os.write(master, reply)
+            time.sleep(0.02)
+            os.write(master, REQUEST)
+            reply = readReply(master, 41)
+            # someone talks over the second reply
+            os.write(master, reply[:10] + b'\xff' + reply[11:])
+            time.sleep(0.02)
+            os.write(master, REQUEST)
+            readReply(master, 41)
+        t = threading.Thread(target=bus)
+        t.start()
+        serveUntil(server, lambda: server.responseTime.count == 3)
+        t.join()
+        if server.responseTime.count != 3: raise AssertionError(f'{server.responseTime.count} replies')
+        if server.echoCount != 1 or server.collisions != 1: raise AssertionError(f'echoes {server.echoCount} collisions {server.collisions}')
+        if server.totalPacketCount != 3 or server.lateReplies != 0: raise AssertionError(f'{server.totalPacketCount} frames, {server.lateReplies} late')
+        log.info(f'Echo dropped and collision counted')
+    finally:
+        server.close()
+        os.close(master)
+        os.close(slave)
+
+
+def test_late_reply():
+    '''
+    A request followed by the start of the masters next frame before we reply is a late reply.
+    '''
+    master, slave, server = createServer()
+    try:
+        os.write(master, REQUEST + REQUEST[:4])
+        serveUntil(server, lambda: server.responseTime.count == 1)
+        if server.lateReplies != 1: raise AssertionError(f'{server.lateReplies} late replies')
+    finally:
+        server.close()
+        os.close(master)
+        os.close(slave)
+
+
+if __name__ == "__main__":
+    test_split_frame()
+    test_low_latency_on_pty()
+    test_echo_discarded()
+    test_late_reply()
@@ -7,24 +7,33 @@ import time
 log = logging.getLogger(__name__)
 
 class Watchdog:
+    '''
+    Exits if any thread that has called update stops calling it for timeout seconds.
+    Threads identify themselves with a key so one busy thread cant hide a stuck one.
+    '''
     def __init__(self, timeout=30):
-        self.time = None
+        self.times = {}
         self.timeout = timeout
 
-    def update(self):
-        self.time = time.time()
+    def update(self, key=None):
+        self.times[key] = time.time()
+
+    @property
+    def time(self):
+        return min(self.times.values())
 
     def run(self):
         while True:
             if time.time() - self.time > self.timeout:
-                log.error('Watchdog timeout')
+                log.error(f'Watchdog timeout {[k for k, t in self.times.items() if time.time() - t > self.timeout]}')
                 faulthandler.dump_traceback()
                 os._exit(1)
 
             time.sleep(self.timeout)
 
-    def start(self):
-        self.update()
+    def start(self, keys=(None,)):
+        for key in keys:
+            self.update(key)
         t = threading.Thread(target=self.run)
         t.daemon = True
         t.start()